@@ -0,0 +1,58 @@
+'''Measure memory taken by the parsed tree of a large program
+
+Run from the root of the repository:
+    python3 -m benchmarks.ast_memory [statements]
+'''
+import sys
+import tracemalloc
+
+from duh.ast import *
+from duh.lang import Source
+from duh.lexer import lex
+from duh.parser import parse_tokens
+
+
+def program(statements):
+    '''Source with `statements` assignments, prints and loops'''
+    lines = ["var x", "var y", "cell n 500"]
+    for i in range(statements // 3):
+        lines.append(f"(= x (+ (- y {i % 500}) (<< x 2) (& n y)))")
+        lines.append(f"if (< x {i % 100}) print (^ x y) else print n")
+        lines.append("while (> x y) { (= x (- x 1)) }")
+    return "\n".join(lines) + "\n"
+
+
+def fields(node):
+    '''Values of attributes of node, with or without __slots__, so trees
+    of older versions can be measured too'''
+    if hasattr(node, '__dict__'):
+        return list(vars(node).values())
+    return [getattr(node, slot) for slot in node.__slots__]
+
+
+def count_nodes(root):
+    count = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        count += 1
+        for value in fields(node):
+            if isinstance(value, ASTNode):
+                stack.append(value)
+            elif isinstance(value, list):
+                stack += [item for item in value if isinstance(item, ASTNode)]
+    return count
+
+
+def main(statements):
+    text = program(statements)
+    tracemalloc.start()
+    tree = parse_tokens(lex(Source('benchmark', text)))
+    memory, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"source {len(text) / 1e6:.1f} MB, {count_nodes(tree)} nodes")
+    print(f"tree {memory / 1e6:.0f} MB, peak {peak / 1e6:.0f} MB")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 90_000)
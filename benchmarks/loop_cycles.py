@@ -0,0 +1,65 @@
+'''Count instructions executed by loops and if/else statements
+
+Run from the root of the repository:
+    python3 -m benchmarks.loop_cycles
+Run it before and after a change of the layout of while and if to see
+how many instructions and taken jumps it saves.
+'''
+import contextlib
+import io
+
+from duh.lang import Source
+from duh.lexer import lex
+from duh.parser import parse_tokens
+from duh.compiler.compile import compile_program
+from duh.compiler.core import SimpleCompiler
+from duh.pmc import Instruction
+from duh.profiler import ProfilingMachine
+
+
+def read_example(name):
+    with open(f"examples/{name}.duh", encoding="utf-8") as source_file:
+        return source_file.read()
+
+
+programs = {
+    'powers_of_two': read_example('powers_of_two'),
+    'count to 400': '''
+var i
+(= i 0)
+while (< i 400) (= i (+ i 1))
+''',
+    'if/else in loop': '''
+var i
+var even
+var odd
+(= i 0)
+while (< i 150) {
+  if (== (& i 1) 0) (= even (+ even 1)) else (= odd (+ odd 1))
+  (= i (+ i 1))
+}
+print even
+print odd
+''',
+}
+
+
+def taken_jumps(machine):
+    '''Executed unconditional jumps and taken conditional ones'''
+    jumps = sum(machine.kinds[Instruction.JUMP * 4:Instruction.JUMP * 4 + 4])
+    return jumps + sum(machine.taken)
+
+
+def main():
+    for name, text in programs.items():
+        program = parse_tokens(lex(Source(name, text)))
+        instructions = compile_program(program, SimpleCompiler)
+        machine = ProfilingMachine()
+        with contextlib.redirect_stdout(io.StringIO()):
+            machine.run(instructions)
+        print(f"{name:>16} executed {machine.total():>6}"
+              f" jumps {taken_jumps(machine):>5} size {len(instructions):>4}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+'''Time parsing of deeply nested programs
+
+Run from the root of the repository:
+    python3 -m benchmarks.parse_depth [depth ...]
+'''
+import sys
+import time
+
+from duh.lang import Source
+from duh.lexer import lex
+from duh.parser import parse_tokens
+
+
+def nested_parens(depth):
+    '''Print of (+ 1 (+ 1 ... 1)) nested `depth` times'''
+    return "var x\nprint " + "(+ 1 " * depth + "x" + ")" * depth + "\n"
+
+
+def nested_whiles(depth):
+    '''`depth` while loops, each inside the block of the previous one'''
+    return "var x\n" + "while x {\n" * depth + "print x\n" + "}\n" * depth
+
+
+programs = {
+    'parens': nested_parens,
+    'while blocks': nested_whiles,
+}
+
+
+def main(depths):
+    for name, program in programs.items():
+        for depth in depths:
+            text = program(depth)
+            start = time.perf_counter()
+            parse_tokens(lex(Source('benchmark', text)))
+            elapsed = time.perf_counter() - start
+            print(f"{name:>12} {depth:>8} {elapsed:8.2f} s")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10_000, 100_000])
@@ -3,3 +3,6 @@ from duh import lang
 from duh import parser
 from duh import pmc
 from duh import compiler
+from duh import translator
+from duh import profiler
+from duh import trace
@@ -1,4 +1,8 @@
 # Definitions of AST nodes
+#
+# Nodes use __slots__ since the tree of a large program is kept alive
+# during the whole compilation. Nodes built by the parser keep the token
+# they start with and compute their span from it only when asked.
 
 
 class ASTPrinter:
@@ -16,13 +20,23 @@ class ASTPrinter:
 
 
 class ASTNode:
+    __slots__ = ()
+
+    @property
+    def span(self):
+        if self.start is not None:
+            return self.start.span
+
     def print(self, printer):
         pass
 
 
 class ProgramNode(ASTNode):
+    __slots__ = ('instructions', 'start')
+
     def __init__(self):
         self.instructions = []
+        self.start = None
 
     def print(self, printer):
         printer.print("Program")
@@ -33,50 +47,77 @@ class ProgramNode(ASTNode):
 
 
 class IdentifierNode(ASTNode):
+    __slots__ = ('identifier',)
+
     def __init__(self, identifier):
         self.identifier = identifier
 
+    @property
+    def span(self):
+        return self.identifier.span
+
     def print(self, printer):
         printer.print(f"Identifier: {self.identifier}")
 
 
 class LiteralNode(ASTNode):
+    __slots__ = ('literal',)
+
     def __init__(self, literal):
         self.literal = literal
 
+    @property
+    def span(self):
+        return self.literal.span
+
     def print(self, printer):
         printer.print(f"Literal: {self.literal}")
 
 
 class OperatorNode(ASTNode):
+    __slots__ = ('operator',)
+
     def __init__(self, operator):
         self.operator = operator
 
+    @property
+    def span(self):
+        return self.operator.span
+
     def print(self, printer):
         printer.print(f"Operator: {self.operator}")
 
 
 class VarNode(ASTNode):
+    __slots__ = ('name', 'start')
+
     def __init__(self, name):
         self.name = name
+        self.start = None
 
     def print(self, printer):
         printer.print(f"Var: {self.name}")
 
 
 class CellNode(ASTNode):
+    __slots__ = ('name', 'address', 'start')
+
     def __init__(self, name, address):
         self.name = name
         self.address = address
+        self.start = None
 
     def print(self, printer):
         printer.print(f"Cell: {self.name} at {self.address}")
 
 
 class WhileNode(ASTNode):
+    __slots__ = ('condition', 'block', 'start')
+
     def __init__(self, condition, block):
         self.condition = condition
         self.block = block
+        self.start = None
 
     def print(self, printer):
         printer.print("While")
@@ -89,10 +130,13 @@ class WhileNode(ASTNode):
 
 
 class IfNode(ASTNode):
+    __slots__ = ('condition', 'block', 'else_block', 'start')
+
     def __init__(self, condition, block, else_block=None):
         self.condition = condition
         self.block = block
         self.else_block = else_block
+        self.start = None
 
     def print(self, printer):
         printer.print("If")
@@ -110,8 +154,11 @@ class IfNode(ASTNode):
 
 
 class ExpressionNode(ASTNode):
+    __slots__ = ('args', 'start')
+
     def __init__(self, args):
         self.args = args
+        self.start = None
 
     def print(self, printer):
         printer.print("Expression")
@@ -124,8 +171,11 @@ class ExpressionNode(ASTNode):
 
 
 class BlockNode(ASTNode):
+    __slots__ = ('instructions', 'start')
+
     def __init__(self, instructions):
         self.instructions = instructions
+        self.start = None
 
     def print(self, printer):
         printer.print("Block")
@@ -136,11 +186,44 @@ class BlockNode(ASTNode):
 
 
 class PrintNode(ASTNode):
+    __slots__ = ('expression', 'start')
+
     def __init__(self, expression):
         self.expression = expression
+        self.start = None
 
     def print(self, printer):
         printer.print("Print")
         printer.push()
         self.expression.print(printer)
         printer.pop()
+
+
+def copy_tree(node):
+    '''Copy of the tree, tokens are shared with the original
+    Nodes are copied without recursion, so nesting depth isn't limited
+    '''
+    root = copy_node(node)
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for slot in node.__slots__:
+            value = getattr(node, slot)
+            if isinstance(value, ASTNode):
+                value = copy_node(value)
+                stack.append(value)
+            elif isinstance(value, list):
+                value = [
+                    copy_node(item) if isinstance(item, ASTNode) else item
+                    for item in value
+                ]
+                stack += [item for item in value if isinstance(item, ASTNode)]
+            setattr(node, slot, value)
+    return root
+
+
+def copy_node(node):
+    copied = object.__new__(type(node))
+    for slot in node.__slots__:
+        setattr(copied, slot, getattr(node, slot))
+    return copied
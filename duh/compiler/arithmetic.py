@@ -0,0 +1,376 @@
+# Multiplication and division routines
+
+from duh.compiler.core import *
+from duh.lang import *
+from duh.compiler.folding import IMMEDIATE_LIMIT
+
+
+def build_multiplication(cell):
+    '''Routine multiplying cell x by cell y with shift and add,
+    `cell` gives cells of the routine by name
+    Returns its code and entry points by operator
+
+    Bits of the multiplier are taken from the bottom until the rest
+    is 0 or -1, -1 stands for all remaining bits set, so negative
+    numbers need no correction and values may wrap around.
+
+    multiply:
+    STORE return
+    LOAD 0
+    STORE product
+    LOAD y
+    loop:
+    JZERO done
+    ADD 1
+    JZERO negative
+    AND 1
+    JZERO odd
+    shift:
+    LOAD x
+    SHL 1
+    STORE x
+    LOAD y
+    SHR 1
+    STORE y
+    JUMP loop
+    odd:
+    LOAD product
+    ADD x
+    STORE product
+    JUMP shift
+    negative:
+    LOAD product
+    SUB x
+    JUMP @return
+    done:
+    LOAD product
+    JUMP @return
+    '''
+    x, y, product, back = cell('x'), cell('y'), cell('product'), cell('return')
+    multiply = store(back)
+    shift = operation(Instruction.LOAD, x)
+    odd = operation(Instruction.LOAD, product)
+    negative = operation(Instruction.LOAD, product)
+    done = operation(Instruction.LOAD, product)
+    loop = jump(Instruction.JZERO, done)
+    code = CompiledInstructions([
+        multiply,
+        immediate(Instruction.LOAD, 0),
+        store(product),
+        operation(Instruction.LOAD, y),
+        loop,
+        immediate(Instruction.ADD, 1),
+        jump(Instruction.JZERO, negative),
+        immediate(Instruction.AND, 1),
+        jump(Instruction.JZERO, odd),
+        shift,
+        immediate(Instruction.SHL, 1),
+        store(x),
+        operation(Instruction.LOAD, y),
+        immediate(Instruction.SHR, 1),
+        store(y),
+        jump(Instruction.JUMP, loop),
+        odd,
+        operation(Instruction.ADD, x),
+        store(product),
+        jump(Instruction.JUMP, shift),
+        negative,
+        operation(Instruction.SUB, x),
+        operation(Instruction.JUMP, back),
+        done,
+        operation(Instruction.JUMP, back),
+    ])
+    return code, {Operator.MUL: multiply}
+
+
+def build_division(cell):
+    '''Routine dividing cell x by cell y with shift and subtract,
+    `cell` gives cells of the routine by name
+    Returns its code and entry points by operator, the one of / leaves
+    the quotient in AC and the one of % leaves the remainder
+
+    The quotient is rounded towards zero and the remainder has the sign
+    of the dividend. Dividing by zero gives quotient 0 and the dividend
+    as remainder. Magnitudes are divided like in restoring division,
+    but the divisor is shifted instead of the dividend: it's doubled
+    while it's at most half of the dividend, then halved back and
+    subtracted wherever it fits. Magnitudes are kept negated, so every
+    one of them fits into a word and nothing overflows.
+    `result` holds address of the cell with the result.
+
+    divide:
+    STORE return
+    LOAD .quotient
+    STORE result
+    LOAD x
+    XOR y
+    JUMP start
+    remainder:
+    STORE return
+    LOAD .x
+    STORE result
+    LOAD x
+    NOT
+    start:
+    STORE sign
+    LOAD 0
+    STORE quotient
+    LOAD y
+    JNEG negative_divisor
+    NOT
+    ADD 1
+    STORE y
+    negative_divisor:
+    STORE w
+    LOAD x
+    JNEG negative_dividend
+    NOT
+    ADD 1
+    STORE x
+    negative_dividend:
+    ADD 1
+    SHR 1
+    STORE limit
+    LOAD w
+    JZERO signed
+    JUMP test
+    double:
+    LOAD w
+    SHL 1
+    STORE w
+    test:
+    SUB limit
+    NOT
+    JNEG double
+    JUMP step
+    halve:
+    LOAD w
+    SHR 1
+    STORE w
+    step:
+    LOAD quotient
+    SHL 1
+    STORE quotient
+    LOAD w
+    SUB x
+    JNEG next
+    LOAD x
+    SUB w
+    STORE x
+    LOAD quotient
+    ADD 1
+    STORE quotient
+    next:
+    LOAD w
+    SUB y
+    JNEG halve
+    signed:
+    LOAD sign
+    JNEG negate
+    LOAD *result
+    JUMP @return
+    negate:
+    LOAD 0
+    SUB *result
+    JUMP @return
+    '''
+    x, y, back = cell('x'), cell('y'), cell('return')
+    result, sign, limit = cell('result'), cell('sign'), cell('limit')
+    quotient, w = cell('quotient'), cell('w')
+    divide = store(back)
+    remainder = store(back)
+    start = store(sign)
+    negative_divisor = store(w)
+    negative_dividend = immediate(Instruction.ADD, 1)
+    double = operation(Instruction.LOAD, w)
+    test = operation(Instruction.SUB, limit)
+    halve = operation(Instruction.LOAD, w)
+    step = operation(Instruction.LOAD, quotient)
+    next_step = operation(Instruction.LOAD, w)
+    signed = operation(Instruction.LOAD, sign)
+    negate = immediate(Instruction.LOAD, 0)
+    code = CompiledInstructions([
+        divide,
+        Instruction(Instruction.LOAD, quotient, Address.IMMEDIATE),
+        store(result),
+        operation(Instruction.LOAD, x),
+        operation(Instruction.XOR, y),
+        jump(Instruction.JUMP, start),
+        remainder,
+        Instruction(Instruction.LOAD, x, Address.IMMEDIATE),
+        store(result),
+        operation(Instruction.LOAD, x),
+        Instruction(Instruction.NOT),
+        start,
+        immediate(Instruction.LOAD, 0),
+        store(quotient),
+        operation(Instruction.LOAD, y),
+        jump(Instruction.JNEG, negative_divisor),
+        Instruction(Instruction.NOT),
+        immediate(Instruction.ADD, 1),
+        store(y),
+        negative_divisor,
+        operation(Instruction.LOAD, x),
+        jump(Instruction.JNEG, negative_dividend),
+        Instruction(Instruction.NOT),
+        immediate(Instruction.ADD, 1),
+        store(x),
+        negative_dividend,
+        immediate(Instruction.SHR, 1),
+        store(limit),
+        operation(Instruction.LOAD, w),
+        jump(Instruction.JZERO, signed),
+        jump(Instruction.JUMP, test),
+        double,
+        immediate(Instruction.SHL, 1),
+        store(w),
+        test,
+        Instruction(Instruction.NOT),
+        jump(Instruction.JNEG, double),
+        jump(Instruction.JUMP, step),
+        halve,
+        immediate(Instruction.SHR, 1),
+        store(w),
+        step,
+        immediate(Instruction.SHL, 1),
+        store(quotient),
+        operation(Instruction.LOAD, w),
+        operation(Instruction.SUB, x),
+        jump(Instruction.JNEG, next_step),
+        operation(Instruction.LOAD, x),
+        operation(Instruction.SUB, w),
+        store(x),
+        operation(Instruction.LOAD, quotient),
+        immediate(Instruction.ADD, 1),
+        store(quotient),
+        next_step,
+        operation(Instruction.SUB, y),
+        jump(Instruction.JNEG, halve),
+        signed,
+        jump(Instruction.JNEG, negate),
+        Instruction(Instruction.LOAD, result, Address.INDIRECT),
+        operation(Instruction.JUMP, back),
+        negate,
+        Instruction(Instruction.SUB, result, Address.INDIRECT),
+        operation(Instruction.JUMP, back),
+    ])
+    return code, {Operator.DIV: divide, Operator.MOD: remainder}
+
+
+def build_constant_multiplication(factor: Address, value):
+    '''Multiply value at `factor` by constant `value` with shifts
+    and additions or subtractions of `factor`, one for every nonzero
+    digit of `value` in non-adjacent form, which has the fewest of them
+
+    For 7 = 8 - 1 with digits 1 0 0 -1, most significant first:
+    LOAD factor
+    SHL 3
+    SUB factor
+    '''
+    digits = signed_digits(value)
+    if not digits:
+        return CompiledInstructions([immediate(Instruction.LOAD, 0)])
+    position = len(digits) - 1
+    if digits[position] > 0:
+        instructions = CompiledInstructions(
+            [operation(Instruction.LOAD, factor)])
+    else:
+        instructions = CompiledInstructions([
+            immediate(Instruction.LOAD, 0),
+            operation(Instruction.SUB, factor),
+        ])
+    for i in reversed(range(position)):
+        if digits[i] == 0: continue
+        instructions.append(immediate(Instruction.SHL, position - i))
+        code = Instruction.ADD if digits[i] > 0 else Instruction.SUB
+        instructions.append(operation(code, factor))
+        position = i
+    if position:
+        instructions.append(immediate(Instruction.SHL, position))
+    return instructions
+
+
+def signed_digits(value):
+    '''Digits of value in non-adjacent form, least significant first
+    Every digit is -1, 0 or 1 and no two adjacent digits are nonzero
+    '''
+    digits = []
+    while value:
+        digit = 2 - (value & 3) if value & 1 else 0
+        digits.append(digit)
+        value = (value - digit) >> 1
+    return digits
+
+
+def build_power_division(dividend, value, remainder=False):
+    '''Divide by constant `value`, plus or minus a power of two, with
+    shifts, dividend are instructions leaving the value in AC
+
+    Negative dividends are rounded towards zero like in build_division.
+
+    dividend:
+    JNEG negative
+    SHR k                       AND 2^k-1 with remainder
+    JUMP end
+    negative:
+    ADD 2^k-1                   NOT, ADD 1, AND 2^k-1, NOT, ADD 1
+    SHR k                       with remainder
+    end:
+    NOT                         when value is negative
+    ADD 1                       without remainder
+    '''
+    shift = power_of_two(value)
+    mask = (1 << shift) - 1
+    if remainder:
+        positive = [immediate(Instruction.AND, mask)]
+        negative = [Instruction(Instruction.NOT),
+                    immediate(Instruction.ADD, 1),
+                    immediate(Instruction.AND, mask),
+                    Instruction(Instruction.NOT),
+                    immediate(Instruction.ADD, 1)]
+    else:
+        positive = [immediate(Instruction.SHR, shift)]
+        negative = [immediate(Instruction.ADD, mask),
+                    immediate(Instruction.SHR, shift)]
+    instructions = CompiledInstructions()
+    instructions += dividend
+    if shift:
+        instructions.append(jump(Instruction.JNEG, negative[0]))
+        instructions += CompiledInstructions(positive)
+        instructions.append(
+            Instruction(Instruction.JUMP, label_after(negative[-1]),
+                        Address.IMMEDIATE))
+        instructions += CompiledInstructions(negative)
+    if value < 0 and not remainder:
+        instructions.append(Instruction(Instruction.NOT))
+        instructions.append(immediate(Instruction.ADD, 1))
+    return instructions
+
+
+def power_of_two(value):
+    '''Exponent of power of two equal to absolute value of `value`,
+    None if it isn't one or its mask doesn't fit into an immediate operand
+    '''
+    value = abs(value)
+    if value == 0 or value & (value - 1) or value - 1 > IMMEDIATE_LIMIT:
+        return None
+    return value.bit_length() - 1
+
+
+def store(address: Address):
+    return Instruction(Instruction.STORE, address, Address.IMMEDIATE)
+
+
+def operation(code, address: Address):
+    '''Instruction using value at address, or address itself
+    if it's a literal'''
+    return Instruction(code, address, address.mode)
+
+
+def immediate(code, value):
+    return Instruction(code, Address(value, Address.IMMEDIATE),
+                       Address.IMMEDIATE)
+
+
+def jump(code, target: Instruction):
+    return Instruction(code, Label(target), Address.IMMEDIATE)
@@ -7,17 +7,23 @@ from duh.compiler.core import *
 from duh.compiler.expressions import *
 from duh.compiler.conditionals import *
 from duh.compiler.while_loops import *
+from duh.compiler.peephole import *
+from duh.compiler.folding import *
+from duh.compiler.hoisting import *
 
 
 def compile_block(node: ASTNode, compiler: Compiler) -> CompiledInstructions:
-    return sum((compile_node(instr, compiler) for instr in node.instructions),
-               start=CompiledInstructions())
+    instructions = CompiledInstructions()
+    for instr in node.instructions:
+        instructions += compile_node(instr, compiler)
+    # Code after the block may be reached without executing it
+    compiler.values.forget()
+    return instructions
 
 
 def compile_print(node: ASTNode, compiler: Compiler) -> CompiledInstructions:
     instructions, address = evaluate_argument(node.expression, compiler)
     instructions.append(Instruction(Instruction.PRINT, address, address.mode))
-    compiler.variables.tvs.pop(compiler)
     return instructions
 
 
@@ -26,12 +32,46 @@ def no_compile(node: ASTNode, compiler: Compiler):
 
 
 def compile_program(program_node: ProgramNode,
-                    Compiler) -> CompiledInstructions:
+                    Compiler,
+                    optimizer=None,
+                    fold=True,
+                    hoist=True) -> CompiledInstructions:
+    '''Compile program, optimising it with `optimizer`
+    By default PeepholeOptimizer with all rules is used
+    With `fold` constant expressions are folded before compilation
+    With `hoist` loop-invariant expressions are moved before their loops,
+    unless the program fits into memory only without that
+    '''
+    if optimizer is None:
+        optimizer = PeepholeOptimizer()
+    if fold:
+        program_node = fold_program(program_node)
+    if hoist:
+        counters = optimizer.removed.copy(), optimizer.retargeted.copy()
+        try:
+            return compile_tree(hoist_program(copy_tree(program_node)),
+                                Compiler, optimizer)
+        except MemoryOverflow:
+            # Hoisted values take cells and code storing them
+            optimizer.removed, optimizer.retargeted = counters
+    return compile_tree(program_node, Compiler, optimizer)
+
+
+def compile_tree(program_node: ProgramNode, Compiler,
+                 optimizer) -> CompiledInstructions:
+    '''Compile transformed tree of the program into final code'''
     variables = variables_from_node(program_node)
     compiler = Compiler(variables, node_type_to_compiler)
     instructions = compile_node(program_node, compiler)
+    instructions.linearize()
     instructions.append(Instruction(Instruction.STOP))
+    instructions += compiler.routines.code
+    instructions = optimizer.optimize(instructions)
+    instructions.temporary_cells = allocate_temporaries(
+        instructions, variables)
     assign_addresses(instructions, variables)
+    resolve_labels(instructions)
+    instructions.source_map = SourceMap(instructions)
     return instructions
 
 
@@ -82,35 +82,28 @@ def build_pattern_A_if(condition, block, else_block, jump):
     '''Compile if into the following form
     condition:
     {jump} if:
-    JUMP else:
-    if:
-    JUMP endif:
     else:
+    JUMP endif:
+    if:
     endif:
+
+    Without else block JUMP endif directly follows the jump to if
     '''
     instructions = CompiledInstructions()
     instructions += condition
+    if not block and not else_block:
+        return instructions
 
-    if block:
-        jump_to_if = Instruction(jump, address_mode=Address.IMMEDIATE)
-        jump_to_else = Instruction(Instruction.JUMP,
-                                   address_mode=Address.IMMEDIATE)
-
-        instructions.append(jump_to_if)
-        instructions.append(jump_to_else)
-
-        instructions += block
-        jump_to_if.address = block[0].line
-        jump_to_else.address = next_address(block[-1].line)
-
+    jump_to_if = Instruction(jump, address_mode=Address.IMMEDIATE)
+    jump_to_end = Instruction(Instruction.JUMP,
+                              address_mode=Address.IMMEDIATE)
+    instructions.append(jump_to_if)
     if else_block:
-        jump_to_else.address = else_block[0].line
-        jump_to_end = Instruction(Instruction.JUMP,
-                                  address_mode=Address.IMMEDIATE)
-        jump_to_end.address = next_address(else_block[-1].line)
-
-        instructions.append(jump_to_end)
         instructions += else_block
+    instructions.append(jump_to_end)
+    jump_to_if.address = label_after(jump_to_end)
+    instructions += block
+    jump_to_end.address = label_after(instructions[-1])
 
     return instructions
 
@@ -126,21 +119,22 @@ def build_pattern_B_if(condition, block, else_block, jump):
     '''
     instructions = CompiledInstructions()
     instructions += condition
-    jump_to_else = Instruction(jump, address_mode=Address.IMMEDIATE)
+    if not block and not else_block:
+        return instructions
 
-    if block:
-        jump_to_else.address = next_address(block[-1].line)
-        instructions.append(jump_to_else)
+    jump_to_else = Instruction(jump, address_mode=Address.IMMEDIATE)
+    instructions.append(jump_to_else)
     instructions += block
 
     if else_block:
-        jump_to_else.address = else_block[0].line
         jump_to_end = Instruction(Instruction.JUMP,
                                   address_mode=Address.IMMEDIATE)
-        jump_to_end.address = next_address(else_block[-1].line)
-
         instructions.append(jump_to_end)
+        jump_to_else.address = label_after(jump_to_end)
         instructions += else_block
+        jump_to_end.address = label_after(instructions[-1])
+    else:
+        jump_to_else.address = label_after(instructions[-1])
 
     return instructions
 
@@ -7,100 +7,308 @@ from duh.ast import *
 from duh.pmc import *
 from duh.lang import *
 
+import bisect
+import heapq
+
 # Type annotations
 import collections
 
 
-class DependentAddress(Address):
-    def __init__(self, address, transform):
-        self.address = address
-        self.transform = transform
-        self.immediate = False
+class Label(Address):
+    '''Address of `instruction` moved by `offset`
+    Used for jump targets, it's known only after addresses are assigned
+    and replaced with a plain Address by resolve_labels
+    '''
+    def __init__(self, instruction, offset=0):
+        self.instruction = instruction
+        self.offset = offset
+        self.mode = Address.IMMEDIATE
 
     @property
     def value(self):
-        return self.transform(self.address.value)
+        line = self.instruction.line.value
+        return None if line is None else line + self.offset
 
     def __str__(self):
         return f"{self.value}"
 
 
-def next_address(address):
-    return DependentAddress(address, lambda x: x + 1)
+def label_after(instruction):
+    '''Label of address following `instruction`'''
+    return Label(instruction, 1)
+
+
+class Temporary(Address):
+    '''Temporary variable used for evaluating expressions
+    Gets a cell from allocate_temporaries once the code is complete
+    '''
 
 
-class TVS:
-    ''' Temporary Variable Stack 
-    Keeps track of temporary variables used for evaluating expressions
+class Temporaries:
+    '''Temporary variables used in the program
+    Every request creates a new temporary, cells are shared later
+    by temporaries whose lifetimes don't overlap
     '''
     def __init__(self, var_to_address):
         self.var_to_address = var_to_address
-        self.variables = []
-        self.active = 0
-
-    def push(self):
-        if len(self.variables) == self.active:
-            self.create_new_variable()
-        address = self.var_to_address[self.variables[self.active]]
-        self.active += 1
-        return address
+        self.created = 0
 
-    def pop(self, address):
-        if address in self.variables:
-            self.active -= 1
+    def create(self):
+        self.created += 1
+        return Temporary()
 
-    def create_new_variable(self):
-        name = f"$tmp{self.active}"
-        self.variables.append(name)
-        self.var_to_address[name] = Address()
+    def cell(self, index):
+        name = f"$tmp{index}"
+        if name not in self.var_to_address:
+            self.var_to_address[name] = Address()
+        return self.var_to_address[name]
 
 
 class Variables:
     '''Keeps track of all variables'''
-    def __init__(self, var_to_address):
+    def __init__(self, var_to_address, aliases=None):
         self.var_to_address = var_to_address
-        self.tvs = TVS(self.var_to_address)
+        # Name of cell -> names of all cells at its address
+        self.aliases = aliases or {}
+        self.temporaries = Temporaries(self.var_to_address)
 
     def __getitem__(self, item):
         return self.var_to_address[item]
 
 
+class ValueNumbering:
+    '''Values of expressions available in memory along straight-line code
+
+    Values are identified by numbers given to keys built from operators
+    and numbers of their arguments, or from versions of variables.
+    Assigning a variable gives it and variables sharing its cell a new
+    version and any store gives memory a new version, so numbers
+    of outdated values aren't found again.
+    '''
+    def __init__(self, variables: Variables):
+        self.versions = collections.Counter()
+        self.memory = 0
+        # Key -> number of value
+        self.numbers = {}
+        # Key of value -> address holding it
+        self.available = {}
+        # Name of variable -> keys of values it holds
+        self.held = {}
+        self.aliases = variables.aliases
+        # Id of expression -> expression and number of its value, valid
+        # until the next store
+        self.keys = {}
+
+    def number(self, key):
+        return self.numbers.setdefault(key, len(self.numbers))
+
+    def name(self, name):
+        return self.number(('name', name, self.versions[name]))
+
+    def add(self, key, address, holder=None):
+        '''Value with `key` is kept at address, of variable `holder`
+        if it isn't a temporary
+        '''
+        if holder is None or key not in self.available:
+            self.available[key] = address
+        if holder is not None:
+            self.held.setdefault(holder, []).append(key)
+
+    def assign(self, name):
+        '''Variable got a new value'''
+        self.memory += 1
+        self.keys.clear()
+        for alias in self.aliases.get(name, (name, )):
+            self.versions[alias] += 1
+            for key in self.held.pop(alias, ()):
+                self.available.pop(key, None)
+
+    def store(self):
+        '''Any cell may have got a new value'''
+        self.memory += 1
+        self.keys.clear()
+        self.forget()
+
+    def forget(self):
+        '''Forget all values, used where control flow joins'''
+        self.available.clear()
+        self.held.clear()
+
+
+class Routines:
+    '''Routines shared by all places calling them, e.g. multiplication
+
+    Code of a routine is built by its first call and placed after
+    the end of the program, `code` holds code of all of them.
+    Routines keep arguments and other values in their own cells,
+    named $routine.name, and return with JUMP @ to the address
+    they get in AC.
+    '''
+    def __init__(self, variables: Variables):
+        self.variables = variables
+        # Name of routine -> its entry points
+        self.entries = {}
+        self.code = CompiledInstructions()
+
+    def cell(self, routine, name):
+        name = f"${routine}.{name}"
+        if name not in self.variables.var_to_address:
+            self.variables.var_to_address[name] = Address()
+        return self.variables[name]
+
+    def call(self, routine, entry, build):
+        '''Instructions calling `entry` of routine, `build` creates code
+        of the routine from a function giving its cells by name and
+        returns it with entry points
+        '''
+        if routine not in self.entries:
+            code, entries = build(lambda name: self.cell(routine, name))
+            self.code += code
+            self.entries[routine] = entries
+        call = Instruction(Instruction.JUMP,
+                           Label(self.entries[routine][entry]),
+                           Address.IMMEDIATE)
+        back = Instruction(Instruction.LOAD, label_after(call),
+                           Address.IMMEDIATE)
+        return CompiledInstructions([back, call])
+
+
 class CompiledInstructions:
     '''Sequence of instructions in PMC
     May contain additional data created during compialation
+
+    Instructions are kept as a rope of parts, which are either lists of
+    instructions or other CompiledInstructions, so appending and
+    concatenation take constant time. Concatenated sequences are shared,
+    not copied, and shouldn't be modified afterwards.
+    The rope is flattened into a single list once it's iterated
+    or indexed in the middle.
     '''
     def __init__(self, instructions=None, data=None):
         if instructions is None:
             instructions = []
-        self.instructions = instructions
+        self.parts = [instructions]
+        self.length = len(instructions)
+        # Nodes the instructions were compiled from, innermost first
+        self.origins = []
         self.data = data
+        self.source_map = None
+        # Number of cells used for temporary variables
+        self.temporary_cells = 0
 
     def append(self, instruction: Instruction):
-        self.instructions.append(instruction)
+        if type(self.parts[-1]) is not list:
+            self.parts.append([])
+        self.parts[-1].append(instruction)
+        self.length += 1
 
     def __iadd__(self, other):
-        self.instructions += other.instructions
+        if other.length:
+            self.parts.append(other)
+            self.length += other.length
         return self
 
     def __add__(self, other):
-        return CompiledInstructions(self.instructions + other.instructions)
+        result = CompiledInstructions()
+        result += self
+        result += other
+        return result
+
+    @property
+    def instructions(self):
+        return self.linearize()
+
+    def linearize(self):
+        '''Flatten the rope into a single list and return it
+        Origins of every sequence are appended to origins of its instructions
+        '''
+        if len(self.parts) == 1 and not self.origins:
+            part = self.parts[0]
+            if type(part) is list:
+                return part
+
+        result = []
+        origins = []
+        # Stack of (parts, index of the next part, number of origins added)
+        stack = [([self], 0, 0)]
+        while stack:
+            parts, index, added = stack.pop()
+            if index == len(parts):
+                del origins[len(origins) - added:]
+                continue
+            stack.append((parts, index + 1, added))
+            part = parts[index]
+            if type(part) is list:
+                inherited = origins[::-1]
+                for instruction in part:
+                    if inherited:
+                        instruction.origins = instruction.origins + inherited
+                    result.append(instruction)
+            else:
+                origins += reversed(part.origins)
+                stack.append((part.parts, 0, len(part.origins)))
+                part.origins = []
+
+        self.parts = [result]
+        return result
+
+    def first(self):
+        rope = self
+        while type(rope) is not list:
+            rope = next(part for part in rope.parts if len(part))
+        return rope[0]
+
+    def last(self):
+        rope = self
+        while type(rope) is not list:
+            rope = next(part for part in reversed(rope.parts) if len(part))
+        return rope[-1]
 
     def __iter__(self):
-        return self.instructions.__iter__()
+        return self.linearize().__iter__()
 
     def __getitem__(self, index):
-        return self.instructions[index]
+        if index == 0 and self.length:
+            return self.first()
+        if index == -1 and self.length:
+            return self.last()
+        return self.linearize()[index]
 
     def __len__(self):
-        return len(self.instructions)
+        return self.length
 
     def __str__(self):
-        result = f"{len(self.instructions)}\n"
-        for instruction in self.instructions:
+        result = f"{len(self)}\n"
+        for instruction in self:
             result += str(instruction) + '\n'
         return result
 
 
+class SourceMap:
+    '''Maps PMC addresses to AST nodes they were compiled from'''
+    def __init__(self, instructions: CompiledInstructions):
+        self.origins = [instruction.origins for instruction in instructions]
+
+    def __len__(self):
+        return len(self.origins)
+
+    def nodes(self, address):
+        '''Nodes containing instruction at address, innermost first'''
+        if 0 <= address < len(self.origins):
+            return self.origins[address]
+        return []
+
+    def span(self, address):
+        '''Span of the innermost node with known position'''
+        for node in self.nodes(address):
+            if node.span is not None:
+                return node.span
+
+    def line(self, address):
+        span = self.span(address)
+        return span.line if span is not None else None
+
+
 class LoadInstruction(Instruction):
     def __init__(self, address=None, address_mode=Address.DIRECT):
         super().__init__(Instruction.LOAD, address, address_mode)
@@ -121,6 +329,20 @@ class UnsupportedNode(CompilationError):
         super().__init__(message)
 
 
+class MemoryOverflow(CompilationError):
+    def __init__(self, code, data):
+        message = (f"Program needs {code} cells for code and {data} for data,"
+                   f" but memory has only {Machine.MEMORY_SIZE} cells.")
+        super().__init__(message)
+
+
+class CellInCode(MemoryOverflow):
+    def __init__(self, name, address, code):
+        message = (f"Cell {name} at {address} is inside the program,"
+                   f" which needs {code} cells for code.")
+        CompilationError.__init__(self, message)
+
+
 class Compiler:
     pass
 
@@ -135,6 +357,10 @@ class SimpleCompiler(Compiler):
                  node_type_to_compiler: dict[type, CompilerFunction]):
         self.variables = variables
         self.node_type_to_compiler = node_type_to_compiler
+        self.values = ValueNumbering(variables)
+        # Id of expression -> expression and its evaluation cost
+        self.costs = {}
+        self.routines = Routines(variables)
 
 
 def variables_from_node(node: ProgramNode) -> Variables:
@@ -147,7 +373,22 @@ def variables_from_node(node: ProgramNode) -> Variables:
             var_to_address[instruction.name.content] = Address(
                 int(instruction.address.content))
 
-    return Variables(var_to_address)
+    return Variables(var_to_address, cell_aliases(cells_from_node(node)))
+
+
+def cells_from_node(node: ProgramNode):
+    '''Names of cells declared in the program by their address'''
+    cells = {}
+    for instruction in node.instructions:
+        if isinstance(instruction, CellNode):
+            address = int(instruction.address.content)
+            cells.setdefault(address, set()).add(instruction.name.content)
+    return cells
+
+
+def cell_aliases(cells):
+    '''Name of cell -> names of all cells at its address'''
+    return {name: names for names in cells.values() for name in names}
 
 
 def identifier_address(node: ASTNode, compiler: Compiler):
@@ -160,20 +401,99 @@ def literal_address(node: ASTNode):
     return Address(node.literal.value, Address.IMMEDIATE)
 
 
+def allocate_temporaries(instructions: CompiledInstructions,
+                         variables: Variables):
+    '''Give every temporary a cell, reusing cells of dead temporaries
+
+    Lifetime of a temporary spans from its first to its last appearance.
+    Temporaries whose lifetime is entered by a jump from outside of it,
+    e.g. ones living around a loop, keep their cell to the end
+    of the program. Jumps inside the lifetime, like the ones
+    of multiplication and division routines, don't matter.
+    Returns number of cells used.
+    '''
+    index = {id(instr): i for i, instr in enumerate(instructions)}
+    # (target, source) of every jump, sorted by target
+    jumps = sorted(
+        (index[id(instr.address.instruction)] + instr.address.offset, i)
+        for i, instr in enumerate(instructions)
+        if isinstance(instr.address, Label))
+    targets = [target for target, _ in jumps]
+    lifetimes = {}
+    for i, instr in enumerate(instructions):
+        temporary = instr.address
+        if isinstance(temporary, Temporary):
+            lifetimes.setdefault(temporary, [i, i])[1] = i
+
+    free = []
+    active = []
+    cells = 0
+    temporary_to_cell = {}
+    for temporary, (begin, end) in lifetimes.items():
+        first = bisect.bisect_right(targets, begin)
+        last = bisect.bisect_right(targets, end)
+        if any(not begin <= source <= end
+               for _, source in jumps[first:last]):
+            end = len(instructions)
+        while active and active[0][0] < begin:
+            heapq.heappush(free, heapq.heappop(active)[1])
+        if free:
+            cell = heapq.heappop(free)
+        else:
+            cell = cells
+            cells += 1
+        heapq.heappush(active, (end, cell))
+        temporary_to_cell[temporary] = variables.temporaries.cell(cell)
+    for instr in instructions:
+        if isinstance(instr.address, Temporary):
+            instr.address = temporary_to_cell[instr.address]
+    return cells
+
+
 def assign_addresses(instructions: CompiledInstructions, variables: Variables):
-    '''Assign an address to each instruction and variable'''
+    '''Assign an address to each instruction and variable
+    Raises MemoryOverflow when they don't fit into memory of the machine
+    and CellInCode when code covers a cell declared in the program
+    '''
     for i, instr in enumerate(instructions):
         instr.line.value = i
+    # Cells declared in the program aren't given to other variables
+    taken = set()
+    for var, address in variables.var_to_address.items():
+        if address.value is not None:
+            if address.value < len(instructions):
+                raise CellInCode(var, address.value, len(instructions))
+            taken.add(address.value)
     index = 0
+    next_address = len(instructions)
     for i, var in enumerate(variables.var_to_address):
         if variables[var].value is None:
-            variables[var].value = index + len(instructions)
+            while next_address in taken:
+                next_address += 1
+            variables[var].value = next_address
+            next_address += 1
             index += 1
+    if next_address > Machine.MEMORY_SIZE:
+        raise MemoryOverflow(len(instructions), index)
+
+
+def resolve_labels(instructions: CompiledInstructions):
+    '''Replace labels with addresses of their instructions in a single pass
+    Must be called after assign_addresses
+    '''
+    for instruction in instructions:
+        address = instruction.address
+        if isinstance(address, Label):
+            instruction.address = Address(
+                address.instruction.line.value + address.offset, address.mode)
 
 
 def compile_node(node: ASTNode, compiler: Compiler) -> CompiledInstructions:
     if type(node) in compiler.node_type_to_compiler:
-        return compiler.node_type_to_compiler[type(node)](node, compiler)
+        instructions = compiler.node_type_to_compiler[type(node)](node,
+                                                                 compiler)
+        instructions.origins.append(node)
+        return instructions
     else:
         raise UnsupportedNode(node)
 
@@ -1,6 +1,7 @@
 # Compilation of expressions
 
 from duh.compiler.core import *
+from duh.compiler.arithmetic import *
 from duh.lang import *
 from duh.ast import *
 
@@ -17,9 +18,17 @@ def store_in_memory(node: ASTNode,
     else:
         if isinstance(node, ExpressionNode) and len(node.args) == 1:
             return store_in_memory(node.args[0], compiler)
+        values = compiler.values
+        key = value_key(node, values)
+        if address is None and isinstance(values.available.get(key),
+                                          Temporary):
+            # Temporaries are never changed once stored
+            return CompiledInstructions(), values.available[key]
         instructions = compile_expression(node, compiler)
         if address is None:
-            address = compiler.variables.tvs.push()
+            address = compiler.variables.temporaries.create()
+            if key is not None:
+                values.add(key, address)
         instructions.append(
             Instruction(Instruction.STORE, address, Address.IMMEDIATE))
         return instructions, address
@@ -37,6 +46,10 @@ def compile_expression(node: ASTNode,
     elif len(node.args) == 1:
         return compile_expression(node.args[0], compiler)
     else:
+        key = value_key(node, compiler.values)
+        if key in compiler.values.available:
+            address = compiler.values.available[key]
+            return CompiledInstructions([LoadInstruction(address)])
         op = node.args[0].operator
         if op.code in operator_to_compiler:
             return operator_to_compiler[op.code](node, compiler)
@@ -68,20 +81,105 @@ def store_in_ac_binary(expression: ExpressionNode, compiler: Compiler):
     args = expression.args[1:]
     store_in_mem_args = args[1:]
     store_in_ac_arg = args[0]
+    costs = {id(arg): evaluation_cost(arg, compiler) for arg in args}
+    if op.code in commutative_operators and all(
+            cost[1] for cost in costs.values()):
+        store_in_ac_arg, store_in_mem_args = order_operands(
+            args, lambda arg: is_operand(arg, compiler),
+            lambda arg: costs[id(arg)][0])
 
-    arg_results = [
-        evaluate_argument(arg, compiler) for arg in store_in_mem_args
-    ]
-    instructions, addresses = list(zip(*arg_results))
-    instructions = sum(instructions, start=CompiledInstructions())
+    instructions = CompiledInstructions()
+    addresses = []
+    for arg in store_in_mem_args:
+        arg_instructions, address = evaluate_argument(arg, compiler)
+        instructions += arg_instructions
+        addresses.append(address)
     instructions += compile_expression(store_in_ac_arg, compiler)
     for address in addresses:
         instructions.append(Instruction(code, address, address.mode))
-        compiler.variables.tvs.pop(address)
 
     return instructions
 
 
+def order_operands(args, is_operand, needed):
+    '''Order arguments of commutative operation by Sethi-Ullman numbers
+    given by `needed`. Arguments needing most temporaries are evaluated
+    first, the one needing fewest is evaluated into AC and operands
+    are used directly.
+    Returns argument evaluated into AC and arguments kept in memory
+    '''
+    computed = [arg for arg in args if not is_operand(arg)]
+    if not computed:
+        return args[0], args[1:]
+    computed.sort(key=needed, reverse=True)
+    operands = [arg for arg in args if is_operand(arg)]
+    return computed[-1], computed[:-1] + operands
+
+
+def evaluation_cost(node: ASTNode, compiler: Compiler):
+    '''Sethi-Ullman number of expression, the most temporaries it keeps
+    at once while it's evaluated into AC, and whether evaluating it
+    doesn't store anything. Costs are cached in the compiler, so every
+    expression is measured once.
+    '''
+    node = unwrap(node)
+    cached = compiler.costs.get(id(node))
+    if cached is not None and cached[0] is node:
+        return cached[1]
+    cost = expression_cost(node, compiler)
+    compiler.costs[id(node)] = node, cost
+    return cost
+
+
+def expression_cost(node: ASTNode, compiler: Compiler):
+    if not isinstance(node, ExpressionNode):
+        return 0, True
+    code = node.args[0].operator.code
+    args = node.args[1:]
+    costs = {id(arg): evaluation_cost(arg, compiler) for arg in args}
+    pure = code in reusable_operators and all(
+        cost[1] for cost in costs.values())
+    if code == Operator.ASSIGN:
+        return costs[id(args[1])][0], False
+    elif len(args) == 1:
+        # Computed address of dereference is kept in a temporary
+        address = code == Operator.AT and not is_leaf(args[0])
+        return max(costs[id(args[0])][0], int(address)), pure
+
+    ac_arg, mem_args = args[0], args[1:]
+    if code in routine_operators:
+        # Arguments of routines are evaluated into memory but the last
+        ac_arg, mem_args = args[-1], args[:-1]
+    if code in commutative_operators and pure:
+        ac_arg, mem_args = order_operands(args, is_leaf,
+                                          lambda arg: costs[id(arg)][0])
+    stored = needed = 0
+    for arg in mem_args:
+        if not is_leaf(arg):
+            needed = max(needed, stored + costs[id(arg)][0])
+            stored += 1
+    return max(needed, stored + costs[id(ac_arg)][0]), pure
+
+
+def unwrap(node: ASTNode):
+    '''Expression inside parentheses'''
+    while isinstance(node, ExpressionNode) and len(node.args) == 1:
+        node = node.args[0]
+    return node
+
+
+def is_leaf(node: ASTNode):
+    return isinstance(unwrap(node), (IdentifierNode, LiteralNode))
+
+
+def is_operand(node: ASTNode, compiler: Compiler):
+    '''Whether argument is used from memory without computing it'''
+    if is_leaf(node):
+        return True
+    key = value_key(node, compiler.values)
+    return isinstance(compiler.values.available.get(key), Temporary)
+
+
 def evaluate_argument(node: ASTNode, compiler: Compiler):
     '''Evaluates node and stores value in memory in case of expressions.
     In case of literals just returns the address'''
@@ -114,7 +212,16 @@ def compile_assignment(node: ASTNode,
 
     instr = Instruction(Instruction.STORE, address, address_mode)
     instructions.append(instr)
-    compiler.variables.tvs.pop(address)
+
+    values = compiler.values
+    if isinstance(arg, IdentifierNode):
+        key = value_key(node.args[2], values)
+        name = arg.identifier.content
+        values.assign(name)
+        if key is not None:
+            values.add(key, address, name)
+    else:
+        values.store()
     return instructions
 
 
@@ -129,7 +236,6 @@ def compile_dereference(node: ExpressionNode, compiler: Compiler):
     mode = address.mode + 1
     instruction = Instruction(Instruction.LOAD, address, mode)
     instructions.append(instruction)
-    compiler.variables.tvs.pop(address)
     return instructions
 
 
@@ -151,6 +257,91 @@ def compile_decrement(expression, variables):
     return instructions
 
 
+def compile_multiplication(node: ExpressionNode, compiler: Compiler):
+    '''Compiles (* a b), multiplying by a literal with shifts and adds'''
+    args = node.args[1:]
+    if all(evaluation_cost(arg, compiler)[1] for arg in args):
+        ac_arg, mem_args = order_operands(
+            args, lambda arg: is_operand(arg, compiler),
+            lambda arg: evaluation_cost(arg, compiler)[0])
+        node = ExpressionNode([node.args[0]] + mem_args + [ac_arg])
+    multiplicand, multiplier = last_operation(node)
+    if is_literal(multiplicand) and not is_literal(multiplier):
+        multiplicand, multiplier = multiplier, multiplicand
+    if is_literal(multiplier):
+        value = literal_value(multiplier)
+        if value == 0:
+            instructions, address = discard(multiplicand, compiler), None
+        else:
+            instructions, address = evaluate_argument(multiplicand, compiler)
+        instructions += build_constant_multiplication(address, value)
+        return instructions
+    return call_routine('multiply', Operator.MUL, build_multiplication,
+                        [multiplicand, multiplier], compiler)
+
+
+def compile_division(node: ExpressionNode, compiler: Compiler):
+    '''Compiles (/ a b) and (% a b), dividing by a power of two
+    with shifts
+    '''
+    op = node.args[0].operator.code
+    remainder = op == Operator.MOD
+    dividend, divisor = last_operation(node)
+    value = literal_value(divisor) if is_literal(divisor) else None
+    if remainder and value in (1, -1):
+        instructions = discard(dividend, compiler)
+        instructions.append(LoadLiteralInstruction(Address(0)))
+        return instructions
+    if value is not None and power_of_two(value) is not None:
+        return build_power_division(compile_expression(dividend, compiler),
+                                    value, remainder)
+    return call_routine('divide', op, build_division, [dividend, divisor],
+                        compiler)
+
+
+def call_routine(routine, entry, build, args, compiler: Compiler):
+    '''Evaluate arguments into cells x and y of routine and call it'''
+    routines = compiler.routines
+    instructions, address = evaluate_argument(args[0], compiler)
+    instructions += compile_expression(args[1], compiler)
+    instructions.append(
+        Instruction(Instruction.STORE, routines.cell(routine, 'y'),
+                    Address.IMMEDIATE))
+    instructions.append(Instruction(Instruction.LOAD, address, address.mode))
+    instructions.append(
+        Instruction(Instruction.STORE, routines.cell(routine, 'x'),
+                    Address.IMMEDIATE))
+    instructions += routines.call(routine, entry, build)
+    return instructions
+
+
+def last_operation(node: ExpressionNode):
+    '''Arguments of the last operation of left-folded expression,
+    (op a b c) -> (op a b), c
+    '''
+    op, *args = node.args
+    if len(args) == 2:
+        return args
+    return ExpressionNode([op] + args[:-1]), args[-1]
+
+
+def discard(node: ASTNode, compiler: Compiler):
+    '''Evaluate expression whose value isn't used, only if it changes
+    anything
+    '''
+    if evaluation_cost(node, compiler)[1]:
+        return CompiledInstructions()
+    return compile_expression(node, compiler)
+
+
+def is_literal(node: ASTNode):
+    return isinstance(unwrap(node), LiteralNode)
+
+
+def literal_value(node: ASTNode):
+    return unwrap(node).literal.value
+
+
 def transform_comparison_condition(node: ExpressionNode, compiler: Compiler):
     return compile_expression(convert_comparison(node), compiler)
 
@@ -186,9 +377,62 @@ def invert_comparison(node: ExpressionNode):
     return ExpressionNode([op] + args)
 
 
+def value_key(node: ASTNode, values: ValueNumbering):
+    '''Number of value computed by expression for common subexpression
+    elimination, None if the expression changes anything
+    '''
+    cached = values.keys.get(id(node))
+    if cached is not None and cached[0] is node:
+        return cached[1]
+    key = expression_key(node, values)
+    values.keys[id(node)] = node, key
+    return key
+
+
+def expression_key(node: ASTNode, values: ValueNumbering):
+    if isinstance(node, LiteralNode):
+        return values.number(('literal', node.literal.value))
+    elif isinstance(node, IdentifierNode):
+        return values.name(node.identifier.content)
+    elif len(node.args) == 1:
+        return value_key(node.args[0], values)
+
+    code = node.args[0].operator.code
+    if code not in reusable_operators:
+        return None
+    keys = []
+    for arg in node.args[1:]:
+        key = value_key(arg, values)
+        if key is None:
+            return None
+        keys.append(key)
+    if code in commutative_operators:
+        keys.sort()
+    elif code == Operator.AT:
+        # Dereference reads memory as it is now
+        keys.append(values.memory)
+    return values.number((code, *keys))
+
+
+reusable_operators = (Operator.ADD, Operator.SUB, Operator.SHL, Operator.SHR,
+                      Operator.AND, Operator.OR, Operator.XOR, Operator.NOT,
+                      Operator.INC, Operator.DEC, Operator.AT, Operator.MUL,
+                      Operator.DIV, Operator.MOD)
+
+# Operators whose arguments can be given in any order
+commutative_operators = (Operator.ADD, Operator.AND, Operator.OR, Operator.XOR,
+                         Operator.MUL)
+
+# Operators compiled into calls of routines
+routine_operators = (Operator.MUL, Operator.DIV, Operator.MOD)
+
+
 operator_to_compiler = {
     Operator.ASSIGN: compile_assignment,
     Operator.AT: compile_dereference,
     Operator.INC: compile_increment,
     Operator.DEC: compile_decrement,
+    Operator.MUL: compile_multiplication,
+    Operator.DIV: compile_division,
+    Operator.MOD: compile_division,
 }
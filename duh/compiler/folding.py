@@ -0,0 +1,327 @@
+# Constant folding and propagation over the AST
+
+from duh.ast import *
+from duh.lang import *
+from duh.pmc import Machine, to_word
+from duh.compiler.core import cell_aliases, cells_from_node
+
+# Largest absolute value that fits into an immediate operand
+IMMEDIATE_LIMIT = (1 << Machine.ADDR_BITS) - 1
+
+
+def fold_program(node: ProgramNode) -> ProgramNode:
+    '''Fold constant expressions and propagate constant variables
+
+    Values are folded only when no intermediate result leaves 16 bits,
+    so folded code behaves the same as the original on every machine.
+    Folded values are emitted only if they fit into an immediate operand.
+    Branches and loops with conditions known on entry are removed.
+    '''
+    known = Known(cell_aliases(cells_from_node(node)))
+    node.instructions = fold_statements(node.instructions, known)
+    return node
+
+
+class Known(dict):
+    '''Values of variables known to be constant, by name
+
+    Cells declared at the same address share their value, so assigning
+    any of them forgets all of them.
+    '''
+    def __init__(self, aliases, values=()):
+        super().__init__(values)
+        self.aliases = aliases
+
+    def copy(self):
+        return Known(self.aliases, self)
+
+    def forget(self, name):
+        for alias in self.aliases.get(name, (name, )):
+            self.pop(alias, None)
+
+
+def fold_statements(statements, known):
+    '''Fold list of statements, `known` maps names to values'''
+    result = []
+    for statement in statements:
+        result += statement_to_folder[type(statement)](statement, known)
+    return result
+
+
+def fold_declaration(node, known):
+    return [node]
+
+
+def fold_expression_statement(node, known):
+    return [fold_top_expression(node, known)]
+
+
+def fold_print(node: PrintNode, known):
+    node.expression = fold_top_expression(node.expression, known)
+    return [node]
+
+
+def fold_block(node: BlockNode, known):
+    node.instructions = fold_statements(node.instructions, known)
+    return [node]
+
+
+def fold_if(node: IfNode, known):
+    forget_assigned(node.condition, known)
+    node.condition = fold_top_expression(node.condition, known)
+    truth = condition_value(node.condition, known)
+    if truth is True:
+        return fold_block(node.block, known)
+    elif truth is False:
+        if node.else_block is None: return []
+        return fold_block(node.else_block, known)
+
+    known_else = known.copy()
+    fold_block(node.block, known)
+    if node.else_block is not None:
+        fold_block(node.else_block, known_else)
+    meet(known, known_else)
+    return [node]
+
+
+def fold_while(node: WhileNode, known):
+    if condition_value(node.condition, known) is False:
+        # Condition is checked before the first iteration
+        return []
+
+    # Anything assigned in the loop may differ between iterations
+    if stores_through_reference(node):
+        known.clear()
+    forget_assigned(node, known)
+    node.condition = fold_top_expression(node.condition, known)
+    fold_block(node.block, known.copy())
+    return [node]
+
+
+def meet(known, other):
+    '''Keep in `known` only values equal in both'''
+    for name, value in list(known.items()):
+        if other.get(name) != value:
+            del known[name]
+
+
+def fold_top_expression(node, known):
+    '''Fold expression evaluated as a whole and record its assignments'''
+    if stores_through_reference(node):
+        known.clear()
+    if is_operation(node, Operator.ASSIGN) and isinstance(
+            node.args[1], IdentifierNode):
+        # Value of simple assignment is known after it's evaluated
+        forget_assigned(node.args[2], known)
+        node.args[2], value = fold_value(node.args[2], known)
+        name = node.args[1].identifier.content
+        known.forget(name)
+        if value is not None:
+            known[name] = value
+        return node
+
+    forget_assigned(node, known)
+    return fold_expression(node, known)
+
+
+def forget_assigned(node, known):
+    for name in assigned_names(node):
+        known.forget(name)
+
+
+def fold_expression(node, known):
+    '''Replace constant subexpressions of `node` with literals'''
+    return fold_value(node, known)[0]
+
+
+def fold_value(node, known):
+    '''Fold expression, returns it with its value, None if it's not known
+    Arguments are folded first, so every node is evaluated only once
+    from values of its arguments
+    '''
+    if isinstance(node, LiteralNode):
+        return node, evaluate(node, known)
+    elif not isinstance(node, ExpressionNode):
+        value = evaluate(node, known)
+    elif len(node.args) == 1:
+        node.args[0], value = fold_value(node.args[0], known)
+    else:
+        first = 2 if is_operation(node, Operator.ASSIGN) else 1
+        if first == 2 and not isinstance(node.args[1], IdentifierNode):
+            node.args[1] = fold_expression(node.args[1], known)
+        values = []
+        for i in range(first, len(node.args)):
+            node.args[i], value = fold_value(node.args[i], known)
+            values.append(value)
+        value = operation_value(node.args[0].operator.code, values)
+    if value is not None and abs(value) <= IMMEDIATE_LIMIT:
+        return LiteralNode(Literal(str(value), node.span)), value
+    return node, value
+
+
+def evaluate(node, known):
+    '''Value of expression if it's known and fits 16 bits, otherwise None'''
+    if isinstance(node, LiteralNode):
+        return checked(node.literal.value)
+    elif isinstance(node, IdentifierNode):
+        return known.get(node.identifier.content)
+    elif not isinstance(node, ExpressionNode):
+        return None
+    elif len(node.args) == 1:
+        return evaluate(node.args[0], known)
+
+    op = node.args[0].operator.code
+    if op not in operator_to_folder:
+        return None
+    return operation_value(op, [evaluate(arg, known) for arg in node.args[1:]])
+
+
+def operation_value(op, values):
+    '''Value of operation on `values`, None if it's not known'''
+    if op not in operator_to_folder or None in values:
+        return None
+    return operator_to_folder[op](values)
+
+
+def checked(value):
+    '''Value if it doesn't overflow 16 bits'''
+    if value is not None and to_word(value) == value:
+        return value
+
+
+def fold_values(operation, values):
+    '''Left-fold values with binary operation, None on overflow'''
+    result = values[0]
+    for value in values[1:]:
+        result = checked(operation(result, value))
+        if result is None: return None
+    return result
+
+
+def shift(operation):
+    def fold_shift(values):
+        if any(value < 0 for value in values[1:]): return None
+        return fold_values(operation, values)
+
+    return fold_shift
+
+
+def division(operation):
+    '''Folder of division rounding towards zero, values aren't folded
+    when dividing by zero or when a magnitude doesn't fit 16 bits
+    '''
+    def divide(a, b):
+        if b == 0 or checked(-a) is None or checked(-b) is None: return None
+        return operation(a, b)
+
+    return lambda values: fold_values(divide, values)
+
+
+def truncated_quotient(a, b):
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+def truncated_remainder(a, b):
+    remainder = abs(a) % abs(b)
+    return remainder if a >= 0 else -remainder
+
+
+operator_to_folder = {
+    Operator.ADD: lambda values: fold_values(lambda a, b: a + b, values),
+    Operator.SUB: lambda values: fold_values(lambda a, b: a - b, values),
+    Operator.SHL: shift(lambda a, b: a << b),
+    Operator.SHR: shift(lambda a, b: a >> b),
+    Operator.AND: lambda values: fold_values(lambda a, b: a & b, values),
+    Operator.OR: lambda values: fold_values(lambda a, b: a | b, values),
+    Operator.XOR: lambda values: fold_values(lambda a, b: a ^ b, values),
+    Operator.NOT: lambda values: checked(~values[0]),
+    Operator.INC: lambda values: checked(values[0] + 1),
+    Operator.DEC: lambda values: checked(values[0] - 1),
+    Operator.MUL: lambda values: fold_values(lambda a, b: a * b, values),
+    Operator.DIV: division(truncated_quotient),
+    Operator.MOD: division(truncated_remainder),
+}
+
+
+def condition_value(node, known):
+    '''Whether condition of if or while holds, None if it's not known
+    Comparisons are evaluated the way they are compiled
+    '''
+    if (isinstance(node, ExpressionNode) and len(node.args) > 1
+            and node.args[0].operator.code in comparison_to_folder):
+        operation, reverse, test = comparison_to_folder[
+            node.args[0].operator.code]
+        values = [evaluate(arg, known) for arg in node.args[1:]]
+        if None in values:
+            return None
+        if reverse:
+            values = values[::-1]
+        value = operator_to_folder[operation](values)
+        return None if value is None else test(value)
+
+    value = evaluate(node, known)
+    return None if value is None else value != 0
+
+
+# Comparison -> (operation, whether arguments are reversed, test of result)
+comparison_to_folder = {
+    Operator.LT: (Operator.SUB, False, lambda value: value < 0),
+    Operator.GT: (Operator.SUB, True, lambda value: value < 0),
+    Operator.LEQ: (Operator.SUB, True, lambda value: value >= 0),
+    Operator.GEQ: (Operator.SUB, False, lambda value: value >= 0),
+    Operator.EQ: (Operator.XOR, False, lambda value: value == 0),
+    Operator.NEQ: (Operator.XOR, False, lambda value: value != 0),
+}
+
+
+def is_operation(node, code):
+    return (isinstance(node, ExpressionNode) and len(node.args) > 1
+            and isinstance(node.args[0], OperatorNode)
+            and node.args[0].operator.code == code)
+
+
+def assignments(node):
+    '''All assignment expressions inside node'''
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ExpressionNode):
+            if is_operation(node, Operator.ASSIGN):
+                yield node
+            stack += node.args
+        elif isinstance(node, (BlockNode, ProgramNode)):
+            stack += node.instructions
+        elif isinstance(node, (IfNode, WhileNode)):
+            stack += [node.condition, node.block]
+            if isinstance(node, IfNode) and node.else_block is not None:
+                stack.append(node.else_block)
+        elif isinstance(node, PrintNode):
+            stack.append(node.expression)
+
+
+def assigned_names(node):
+    return {
+        assignment.args[1].identifier.content
+        for assignment in assignments(node)
+        if isinstance(assignment.args[1], IdentifierNode)
+    }
+
+
+def stores_through_reference(node):
+    '''Whether node may write to any cell of memory'''
+    return any(not isinstance(assignment.args[1], IdentifierNode)
+               for assignment in assignments(node))
+
+
+statement_to_folder = {
+    VarNode: fold_declaration,
+    CellNode: fold_declaration,
+    ExpressionNode: fold_expression_statement,
+    IdentifierNode: fold_expression_statement,
+    LiteralNode: fold_expression_statement,
+    PrintNode: fold_print,
+    BlockNode: fold_block,
+    IfNode: fold_if,
+    WhileNode: fold_while,
+}
@@ -0,0 +1,232 @@
+# Loop-invariant code motion over the AST
+
+from duh.ast import *
+from duh.lang import *
+from duh.compiler.core import cells_from_node
+from duh.compiler.folding import (assignments, condition_value, evaluate,
+                                  is_operation)
+
+# Operations whose value depends only on values of their arguments
+hoistable_operators = (Operator.ADD, Operator.SUB, Operator.SHL, Operator.SHR,
+                       Operator.AND, Operator.OR, Operator.XOR, Operator.NOT,
+                       Operator.INC, Operator.DEC, Operator.MUL, Operator.DIV,
+                       Operator.MOD)
+
+# Operations failing with negative counts, which aren't moved where they
+# could be evaluated when the source wouldn't evaluate them
+shift_operators = (Operator.SHL, Operator.SHR)
+
+
+class Hoisting:
+    '''Variables holding values of hoisted expressions
+
+    Every value gets a variable named $inv0, $inv1, ..., which can't
+    clash with names from the source. Their declarations are added
+    at the end of the program.
+    '''
+    def __init__(self, cells):
+        # Names of cells declared at every address
+        self.cells = cells
+        self.declarations = []
+
+    def create(self, span):
+        name = Token(f"$inv{len(self.declarations)}", span)
+        self.declarations.append(VarNode(name))
+        return name
+
+
+def hoist_program(node: ProgramNode) -> ProgramNode:
+    '''Move expressions that have the same value in every iteration
+    of a while loop before the loop
+
+    Outer loops are handled first, so an expression leaves all loops
+    it's invariant in. Only dereferences of declared cells at constant
+    addresses are moved, any other cell may be changed by any store.
+    Shifts by counts that may be negative are moved only from places
+    evaluated whenever the loop is entered.
+    '''
+    hoisting = Hoisting(cells_from_node(node))
+    node.instructions = hoist_statements(node.instructions, hoisting)
+    node.instructions += hoisting.declarations
+    return node
+
+
+def hoist_statements(statements, hoisting):
+    result = []
+    for statement in statements:
+        result += statement_to_hoister.get(type(statement),
+                                           keep)(statement, hoisting)
+    return result
+
+
+def keep(node, hoisting):
+    return [node]
+
+
+def hoist_block(node: BlockNode, hoisting):
+    node.instructions = hoist_statements(node.instructions, hoisting)
+    return [node]
+
+
+def hoist_if(node: IfNode, hoisting):
+    hoist_block(node.block, hoisting)
+    if node.else_block is not None:
+        hoist_block(node.else_block, hoisting)
+    return [node]
+
+
+def hoist_while(node: WhileNode, hoisting):
+    '''Evaluate invariant expressions of the loop before it
+    and replace them with variables holding their values
+    '''
+    loop = LoopInvariants(changed_names(node, hoisting.cells), hoisting)
+    replace_in_arguments(node.condition, loop)
+    loop.certain = runs_at_least_once(node)
+    replace_in_statement(node.block, loop)
+    hoist_block(node.block, hoisting)
+    return loop.preheader + [node]
+
+
+def changed_names(node, cells):
+    '''Names whose value may change inside node, None if any of them may'''
+    changed = set()
+    for assignment in assignments(node):
+        target = assignment.args[1]
+        if isinstance(target, IdentifierNode):
+            changed.add(target.identifier.content)
+        elif cell_address(target, cells) is not None:
+            changed |= cells[cell_address(target, cells)]
+        else:
+            return None
+    # Cells declared at the same address change together
+    for names in cells.values():
+        if changed & names:
+            changed |= names
+    return changed
+
+
+def runs_at_least_once(node: WhileNode):
+    return condition_value(node.condition, {}) is True
+
+
+def cell_address(node, cells):
+    '''Address of declared cell (@ address) refers to, None if it's unknown'''
+    if not is_operation(node, Operator.AT):
+        return None
+    address = evaluate(node.args[1], {})
+    return address if address in cells else None
+
+
+class LoopInvariants:
+    '''Invariant expressions of a single loop, equal expressions share
+    a variable, `preheader` holds assignments evaluating them
+    '''
+    def __init__(self, changed, hoisting):
+        self.changed = changed
+        self.hoisting = hoisting
+        self.variables = {}
+        self.preheader = []
+        # Whether expressions being replaced are evaluated
+        # whenever the loop is entered
+        self.certain = True
+
+    def is_invariant(self, node):
+        if isinstance(node, LiteralNode):
+            return True
+        elif isinstance(node, IdentifierNode):
+            return (self.changed is not None
+                    and node.identifier.content not in self.changed)
+        elif not isinstance(node, ExpressionNode):
+            return False
+        elif len(node.args) == 1:
+            return self.is_invariant(node.args[0])
+        elif is_operation(node, Operator.AT):
+            address = cell_address(node, self.hoisting.cells)
+            return (address is not None and self.changed is not None
+                    and not self.changed & self.hoisting.cells[address])
+        return self.is_invariant_operation(node)
+
+    def is_invariant_operation(self, node):
+        return (isinstance(node, ExpressionNode) and len(node.args) > 1
+                and isinstance(node.args[0], OperatorNode)
+                and node.args[0].operator.code in hoistable_operators
+                and (self.certain or is_safe(node))
+                and all(self.is_invariant(arg) for arg in node.args[1:]))
+
+    def variable(self, node):
+        '''Identifier of variable holding value of invariant expression'''
+        key = expression_key(node)
+        if key not in self.variables:
+            name = self.hoisting.create(node.span)
+            self.variables[key] = name
+            assign = OperatorNode(Operator(Operator.ASSIGN, node.span))
+            assignment = ExpressionNode([assign, IdentifierNode(name), node])
+            assignment.start = node.start
+            self.preheader.append(assignment)
+        return IdentifierNode(self.variables[key])
+
+
+def is_safe(node):
+    '''Whether operation can't fail, shifts fail unless their counts
+    are non-negative constants
+    '''
+    if node.args[0].operator.code not in shift_operators:
+        return True
+    counts = [evaluate(arg, {}) for arg in node.args[2:]]
+    return None not in counts and min(counts) >= 0
+
+
+def replace(node, loop: LoopInvariants):
+    '''Replace invariant parts of expression, returns the new expression'''
+    if loop.is_invariant_operation(node):
+        return loop.variable(node)
+    replace_in_arguments(node, loop)
+    return node
+
+
+def replace_in_arguments(node, loop: LoopInvariants):
+    if not isinstance(node, ExpressionNode):
+        return
+    first = 1 if isinstance(node.args[0], OperatorNode) else 0
+    node.args[first:] = [replace(arg, loop) for arg in node.args[first:]]
+
+
+def replace_in_statement(node, loop: LoopInvariants):
+    '''Replace invariant expressions in statement and statements inside'''
+    if isinstance(node, (BlockNode, ProgramNode)):
+        for statement in node.instructions:
+            replace_in_statement(statement, loop)
+    elif isinstance(node, (IfNode, WhileNode)):
+        replace_in_arguments(node.condition, loop)
+        # Blocks may not run on every iteration
+        certain = loop.certain
+        loop.certain = (certain and isinstance(node, WhileNode)
+                        and runs_at_least_once(node))
+        replace_in_statement(node.block, loop)
+        if isinstance(node, IfNode) and node.else_block is not None:
+            replace_in_statement(node.else_block, loop)
+        loop.certain = certain
+    elif isinstance(node, PrintNode):
+        node.expression = replace(node.expression, loop)
+    else:
+        # Value of expression statement isn't used, only its arguments
+        replace_in_arguments(node, loop)
+
+
+def expression_key(node):
+    '''Key equal for expressions that compute the same value'''
+    if isinstance(node, LiteralNode):
+        return 'literal', node.literal.value
+    elif isinstance(node, IdentifierNode):
+        return 'name', node.identifier.content
+    elif len(node.args) == 1:
+        return expression_key(node.args[0])
+    return (node.args[0].operator.code,
+            *(expression_key(arg) for arg in node.args[1:]))
+
+
+statement_to_hoister = {
+    BlockNode: hoist_block,
+    IfNode: hoist_if,
+    WhileNode: hoist_while,
+}
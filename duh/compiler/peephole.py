@@ -0,0 +1,313 @@
+# Peephole optimisation of compiled PMC code
+
+from collections import Counter
+
+from duh.compiler.core import *
+
+
+class PeepholeOptimizer:
+    '''Removes wasteful instruction patterns from compiled code
+
+    `rules` are names of rules from `peephole_rules`, applied in order
+    until none of them changes the code.
+    Runs before assign_addresses, so jump targets are still labels
+    and labels pointing at removed instructions move to the next one.
+    '''
+    def __init__(self, rules=None):
+        if rules is None:
+            rules = default_rules
+        self.rules = list(rules)
+        # Instructions removed and jumps retargeted by each rule
+        self.removed = Counter()
+        self.retargeted = Counter()
+
+    def optimize(self, instructions: CompiledInstructions):
+        '''Returns optimised copy of instructions ending with STOP'''
+        code = Code(list(instructions))
+        changed = True
+        while changed:
+            changed = False
+            for rule in self.rules:
+                removed, retargeted = peephole_rules[rule](code)
+                code.compact()
+                self.removed[rule] += removed
+                self.retargeted[rule] += retargeted
+                changed = changed or removed or retargeted
+        return CompiledInstructions(code.instructions)
+
+    def total_removed(self):
+        return sum(self.removed.values())
+
+    def report(self):
+        result = f"Removed instructions: {self.total_removed()}\n"
+        for rule in self.rules:
+            result += f"{self.removed[rule]:>8} removed"
+            result += f" {self.retargeted[rule]:>8} retargeted  {rule}\n"
+        return result
+
+
+class Code:
+    '''Linear list of instructions with jump targets known
+    Removed instructions are None until the list is compacted
+    '''
+    def __init__(self, instructions):
+        self.instructions = instructions
+        # Labels pointing at each instruction, by id of the instruction
+        self.labels = {}
+        index = {id(instr): i for i, instr in enumerate(instructions)}
+        for instruction in instructions:
+            label = instruction.address
+            if isinstance(label, Label):
+                # Point every label directly at its target instruction
+                target = index[id(label.instruction)] + label.offset
+                instruction.address = Label(instructions[target])
+                self.add_label(instruction.address)
+
+    def add_label(self, label):
+        self.labels.setdefault(id(label.instruction), []).append(label)
+
+    def is_target(self, instruction):
+        return bool(self.labels.get(id(instruction)))
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def __getitem__(self, index):
+        return self.instructions[index]
+
+    def following(self, index):
+        '''Index of the next instruction that wasn't removed'''
+        index += 1
+        while self.instructions[index] is None:
+            index += 1
+        return index
+
+    def remove(self, index):
+        '''Remove instruction, labels pointing at it move to the next one'''
+        instruction = self.instructions[index]
+        labels = self.labels.pop(id(instruction), [])
+        if labels:
+            following = self.instructions[self.following(index)]
+            for label in labels:
+                label.instruction = following
+                self.add_label(label)
+        if isinstance(instruction.address, Label):
+            self.drop_label(instruction.address)
+        self.instructions[index] = None
+
+    def retarget(self, instruction, target):
+        self.drop_label(instruction.address)
+        instruction.address = Label(target)
+        self.add_label(instruction.address)
+
+    def drop_label(self, label):
+        labels = self.labels[id(label.instruction)]
+        labels.remove(label)
+
+    def compact(self):
+        self.instructions[:] = [i for i in self.instructions if i is not None]
+
+
+JUMPS = (Instruction.JUMP, Instruction.JNEG, Instruction.JZERO)
+
+
+def is_label_jump(instruction):
+    return (instruction.code in JUMPS
+            and isinstance(instruction.address, Label))
+
+
+def same_address(first: Address, second: Address):
+    '''Whether addresses are certainly equal'''
+    if first is second:
+        return True
+    return (not isinstance(first, Label) and not isinstance(second, Label)
+            and first.value is not None and first.value == second.value)
+
+
+def remove_load_after_store(code: Code):
+    '''STORE . x; LOAD @ x -> STORE . x'''
+    removed = 0
+    for i in range(len(code) - 1):
+        store, load = code[i], code[i + 1]
+        if store is None or load is None: continue
+        if (store.code == Instruction.STORE
+                and store.address_mode == Address.IMMEDIATE
+                and load.code == Instruction.LOAD
+                and load.address_mode == Address.DIRECT
+                and not code.is_target(load)
+                and same_address(store.address, load.address)):
+            code.remove(i + 1)
+            removed += 1
+    return removed, 0
+
+
+def remove_repeated_load(code: Code):
+    '''LOAD x; LOAD x -> LOAD x'''
+    removed = 0
+    for i in range(len(code) - 1):
+        first, second = code[i], code[i + 1]
+        if first is None or second is None: continue
+        if (first.code == Instruction.LOAD == second.code
+                and first.address_mode == second.address_mode
+                and first.address_mode != Address.RELATIVE
+                and not code.is_target(second)
+                and same_address(first.address, second.address)):
+            code.remove(i + 1)
+            removed += 1
+    return removed, 0
+
+
+def remove_redundant_transfer(code: Code):
+    '''LOAD or STORE . x when AC is known to hold the value already
+
+    Values held by AC are tracked along straight-line code and forgotten
+    at jump targets, after instructions changing AC and, for values
+    of cells, after stores to computed addresses.
+    '''
+    removed = 0
+    holds = set()
+    for i in range(len(code)):
+        instruction = code[i]
+        if code.is_target(instruction):
+            holds = set()
+        opcode, mode = instruction.code, instruction.address_mode
+        if opcode == Instruction.LOAD:
+            value = operand_value(instruction)
+            if value is not None and value in holds:
+                code.remove(i)
+                removed += 1
+            else:
+                holds = {value} if value is not None else set()
+        elif opcode == Instruction.STORE and mode == Address.IMMEDIATE:
+            cell = address_key(instruction.address)
+            if cell is not None and ('cell', cell) in holds:
+                code.remove(i)
+                removed += 1
+            elif cell is not None:
+                holds.add(('cell', cell))
+        elif opcode == Instruction.STORE:
+            holds = {value for value in holds if value[0] == 'literal'}
+        elif opcode not in transparent_operations:
+            holds = set()
+    return removed, 0
+
+
+# Instructions that change neither AC nor memory
+transparent_operations = (Instruction.NULL, Instruction.PRINT,
+                          Instruction.JNEG, Instruction.JZERO)
+
+
+def address_key(address):
+    '''Key identifying cell at address, None if it isn't known'''
+    if isinstance(address, Label):
+        return None
+    if address.value is not None:
+        return 'at', address.value
+    return 'object', id(address)
+
+
+def operand_value(instruction):
+    '''Key of value loaded by LOAD, None if it isn't known'''
+    mode = instruction.address_mode
+    if mode == Address.IMMEDIATE:
+        key = address_key(instruction.address)
+        if key is not None and key[0] == 'at':
+            return 'literal', key[1]
+    elif mode == Address.DIRECT:
+        key = address_key(instruction.address)
+        if key is not None:
+            return 'cell', key
+    return None
+
+
+def remove_dead_temporary_store(code: Code):
+    '''STORE . t when temporary t is never read'''
+    appearances = Counter(
+        id(instruction.address) for instruction in code
+        if isinstance(instruction.address, Temporary))
+    removed = 0
+    for i in range(len(code)):
+        instruction = code[i]
+        if (instruction.code == Instruction.STORE
+                and instruction.address_mode == Address.IMMEDIATE
+                and isinstance(instruction.address, Temporary)
+                and appearances[id(instruction.address)] == 1):
+            code.remove(i)
+            removed += 1
+    return removed, 0
+
+
+def remove_identity_operation(code: Code):
+    '''ADD . 0, SUB . 0, OR . 0, XOR . 0, SHL . 0 and SHR . 0'''
+    removed = 0
+    for i in range(len(code)):
+        instruction = code[i]
+        if (instruction.code in identity_operations
+                and instruction.address_mode == Address.IMMEDIATE
+                and instruction.address.value == 0):
+            code.remove(i)
+            removed += 1
+    return removed, 0
+
+
+identity_operations = (Instruction.ADD, Instruction.SUB, Instruction.OR,
+                       Instruction.XOR, Instruction.SHL, Instruction.SHR)
+
+
+def remove_jump_to_next(code: Code):
+    '''Jump to the following instruction does nothing'''
+    removed = 0
+    for i in range(len(code) - 1):
+        instruction = code[i]
+        if (is_label_jump(instruction)
+                and instruction.address.instruction is code[code.following(i)]):
+            code.remove(i)
+            removed += 1
+    return removed, 0
+
+
+def thread_jumps(code: Code):
+    '''Jump to JUMP . x -> jump to x'''
+    retargeted = 0
+    for instruction in code:
+        if not is_label_jump(instruction): continue
+        target = instruction.address.instruction
+        seen = {id(instruction)}
+        while (target.code == Instruction.JUMP and is_label_jump(target)
+               and id(target) not in seen):
+            seen.add(id(target))
+            target = target.address.instruction
+        if target is not instruction.address.instruction:
+            code.retarget(instruction, target)
+            retargeted += 1
+    return 0, retargeted
+
+
+def remove_unreachable(code: Code):
+    '''Instructions after JUMP or STOP that no jump leads to'''
+    removed = 0
+    reachable = True
+    for i in range(len(code)):
+        instruction = code[i]
+        if code.is_target(instruction):
+            reachable = True
+        if not reachable:
+            code.remove(i)
+            removed += 1
+        elif instruction.code in (Instruction.JUMP, Instruction.STOP):
+            reachable = False
+    return removed, 0
+
+
+peephole_rules = {
+    'load_after_store': remove_load_after_store,
+    'repeated_load': remove_repeated_load,
+    'redundant_transfer': remove_redundant_transfer,
+    'dead_temporary': remove_dead_temporary_store,
+    'identity': remove_identity_operation,
+    'jump_to_next': remove_jump_to_next,
+    'jump_threading': thread_jumps,
+    'unreachable': remove_unreachable,
+}
+
+default_rules = tuple(peephole_rules)
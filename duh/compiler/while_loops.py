@@ -6,6 +6,8 @@ from duh.compiler.conditionals import *
 
 
 def compile_while(node, compiler):
+    # Condition is evaluated again after the block changed variables
+    compiler.values.forget()
     if isinstance(node.condition,
                   ExpressionNode) and len(node.condition.args) > 1:
         op = node.condition.args[0].operator
@@ -77,35 +79,25 @@ def compile_other_op_while(node: IfNode, compiler: Compiler):
 
 def build_pattern_A_while(condition, block, jump):
     '''Compile while into the following form
+    Condition is tested at the bottom, so an iteration takes a single jump
 
-    condition:
-    {jump} body:
-    JUMP endwhile:
+    JUMP condition:
     block:
-    JUMP beginwhile:
+    condition:
+    {jump} block:
     endwhile:
     '''
     instructions = CompiledInstructions()
+    jump_to_condition = Instruction(Instruction.JUMP,
+                                    address_mode=Address.IMMEDIATE)
+    instructions.append(jump_to_condition)
+    instructions += block
     instructions += condition
 
-    if block:
-        jump_to_block = Instruction(jump, address_mode=Address.IMMEDIATE)
-        jump_to_while_end = Instruction(Instruction.JUMP,
-                                        address_mode=Address.IMMEDIATE)
-
-        instructions.append(jump_to_block)
-        instructions.append(jump_to_while_end)
-
-        instructions += block
-        jump_to_block.address = block[0].line
-
-    jump_to_begin = Instruction(Instruction.JUMP,
-                                address_mode=Address.IMMEDIATE)
-    instructions.append(jump_to_begin)
-
-    if block:
-        jump_to_while_end.address = next_address(instructions[-1].line)
-    jump_to_begin.address = instructions[0].line
+    jump_to_block = Instruction(jump, address_mode=Address.IMMEDIATE)
+    instructions.append(jump_to_block)
+    jump_to_condition.address = Label(condition[0])
+    jump_to_block.address = label_after(jump_to_condition)
 
     return instructions
 
@@ -129,8 +121,8 @@ def build_pattern_B_while(condition, block, jump):
                                 address_mode=Address.IMMEDIATE)
     instructions.append(jump_to_begin)
 
-    jump_to_while_end.address = next_address(instructions[-1].line)
-    jump_to_begin.address = instructions[0].line
+    jump_to_while_end.address = label_after(instructions[-1])
+    jump_to_begin.address = Label(instructions[0])
 
     return instructions
 
@@ -5,7 +5,7 @@ KEYWORD_CHARS = string.ascii_letters
 
 NAME_CHARS = string.ascii_letters + string.digits + ':' + '_' + "\'"
 LITERAL_CHARS = string.digits + '-xbo'
-OPERATOR_CHARS = '<=>+-/&|^~!@'
+OPERATOR_CHARS = '<=>+-*/%&|^~!@'
 
 
 def compatible(token, char):
@@ -29,10 +29,17 @@ class TokenGroup:
 
 
 class Source:
-    def __init__(self, filename, text):
+    '''Source of a program, text is None when the file is streamed'''
+    def __init__(self, filename, text=None):
         self.filename = filename
         self.text = text
 
+    def lines(self):
+        if self.text is None:
+            with open(self.filename, "r", encoding="utf-8") as source_file:
+                return source_file.read().splitlines()
+        return self.text.splitlines()
+
 
 class Span:
     def __init__(self, source, line, begin, end):
@@ -79,7 +86,7 @@ keyword_to_str = {keyword: s for s, keyword in str_to_keyword.items()}
 
 class Operator(Token):
     (ASSIGN, EQ, NEQ, LT, LEQ, GT, GEQ, ADD, SUB, SHL, SHR, AND, OR, XOR, NOT,
-     AT, INC, DEC) = range(18)
+     AT, INC, DEC, MUL, DIV, MOD) = range(21)
 
     def __init__(self, code, span):
         super().__init__(opetator_to_str[code], span, TokenGroup.OPERATOR,
@@ -108,6 +115,9 @@ str_to_operator = {
     "@": Operator.AT,
     '++': Operator.INC,
     '--': Operator.DEC,
+    '*': Operator.MUL,
+    '/': Operator.DIV,
+    '%': Operator.MOD,
 }
 
 opetator_to_str = {op: s for s, op in str_to_operator.items()}
@@ -1,55 +1,286 @@
 """Simple lexer for duh language"""
+import collections
+import re
 import string
+from array import array
 from duh.lang import *
 
 
 class Tokens:
+    '''Stream of tokens that allows looking one token ahead
+    Tokens are pulled from the iterable only when needed
+    '''
     def __init__(self, tokens):
-        self.tokens = tokens
+        self.tokens = iter(tokens)
+        self.buffer = collections.deque()
         self.head = 0
 
+    def fill(self, count):
+        '''Make sure there are at least `count` tokens buffered'''
+        while len(self.buffer) < count:
+            token = next(self.tokens, None)
+            if token is None:
+                return False
+            self.buffer.append(token)
+        return True
+
     def next(self):
-        if len(self.tokens) > self.head + 1:
-            return self.tokens[self.head + 1]
+        if self.fill(2):
+            return self.buffer[1]
 
     def current(self):
-        if len(self.tokens) > self.head:
-            return self.tokens[self.head]
+        if self.fill(1):
+            return self.buffer[0]
 
     def advance(self):
         token = self.current()
-        if self.head < len(self.tokens):
+        if self.buffer:
+            self.buffer.popleft()
             self.head += 1
         return token
 
     def empty(self):
-        return len(self.tokens) <= self.head
+        return not self.fill(1)
+
+
+def token_pattern():
+    '''Regular expression matching whitespace followed by a single token
+    Tokens are the same as when growing them char by char while
+    `compatible` allows: runs of name chars, signed decimal literals,
+    longest operators and any other single char.
+    '''
+    name_chars = re.escape(NAME_CHARS)
+    operators = sorted(str_to_operator, key=len, reverse=True)
+    operators = "|".join(re.escape(op) for op in operators)
+    whitespace = re.escape(string.whitespace)
+    return re.compile(f"[{whitespace}]*(?:"
+                      f"(?P<name>[{name_chars}]+)"
+                      f"|(?P<literal>[-+][0-9]+)"
+                      f"|(?P<operator>{operators})"
+                      f"|(?P<other>[^{whitespace}]))")
+
+
+TOKEN_PATTERN = token_pattern()
+
+
+def classify(pattern_group, content):
+    '''Returns TokenGroup and code of token matched by `pattern_group`
+    Code is None for names and literals
+    '''
+    if pattern_group == 'operator':
+        return TokenGroup.OPERATOR, str_to_operator[content]
+    if pattern_group == 'literal':
+        return TokenGroup.LITERAL, None
+    if content in str_to_keyword:
+        return TokenGroup.KEYWORD, str_to_keyword[content]
+    if content in str_to_symbol:
+        return TokenGroup.SYMBOL, str_to_symbol[content]
+    if content[0] not in KEYWORD_CHARS and is_literal(content):
+        return TokenGroup.LITERAL, None
+    return TokenGroup.NAME, None
+
+
+def create_grouped_token(group, code, content, span):
+    if group == TokenGroup.NAME:
+        return Identifier(content, span)
+    if group == TokenGroup.LITERAL:
+        return Literal(content, span)
+    return group_to_token_type[group](code, span)
+
+
+group_to_token_type = {
+    TokenGroup.KEYWORD: Keyword,
+    TokenGroup.SYMBOL: Symbol,
+    TokenGroup.OPERATOR: Operator,
+}
 
 
 def lex(source):
-    tokens = []
-    current_token = ""
+    '''Split source into tokens kept in a compact TokenStore'''
+    return StoredTokens(TokenStore.from_chunks([source.text], source))
+
+
+def lex_file(source_file, source, chunk_size=1 << 16):
+    '''Lazily split file into tokens reading it in chunks'''
+    return Tokens(tokenize(read_chunks(source_file, chunk_size), source))
 
+
+def read_chunks(source_file, chunk_size=1 << 16):
+    return iter(lambda: source_file.read(chunk_size), "")
+
+
+def tokenize(chunks, source):
+    '''Generate token objects from text split into chunks'''
+    for group, code, content, line, begin, end in scan(chunks):
+        span = Span(source, line, begin, end)
+        yield create_grouped_token(group, code, content, span)
+
+
+def scan(chunks):
+    '''Generate (group, code, content, line, begin, end) of tokens
+    in text split into chunks.
+    Token touching the end of a chunk may continue in the next one,
+    so it's held back until more text is read
+    '''
+    chunks = iter(chunks)
+    text = ""
+    # Position of `text` in the whole source
+    offset = 0
+    # Position in `text` right after the last token
+    position = 0
     line = 0
-    char_index = 0
+    ended = False
+    while not ended:
+        chunk = next(chunks, "")
+        if chunk:
+            text = text[position:] + chunk
+            offset += position
+            position = 0
+        else:
+            ended = True
+
+        for match in TOKEN_PATTERN.finditer(text, position):
+            pattern_group = match.lastgroup
+            begin, end = match.span(pattern_group)
+            if end == len(text) and not ended:
+                break
+            if begin != position:
+                line += text.count('\n', position, begin)
+            position = end
+            content = text[begin:end]
+            group, code = classify(pattern_group, content)
+            yield group, code, content, line, offset + begin, offset + end
+
+
+class TokenStore:
+    '''Tokens kept in parallel arrays instead of separate objects
+
+    Keywords, symbols and operators store their code,
+    names and literals store index into table of interned strings.
+    Store can be pickled to cache lexed sources.
+    '''
+    def __init__(self, source):
+        self.source = source
+        self.groups = array('B')
+        self.codes = array('I')
+        self.lines = array('I')
+        self.begins = array('I')
+        self.ends = array('I')
+        self.strings = []
+        self.string_index = {}
+
+    @classmethod
+    def from_chunks(cls, chunks, source):
+        store = cls(source)
+        for token in scan(chunks):
+            store.append(*token)
+        return store
+
+    @classmethod
+    def from_file(cls, source_file, source, chunk_size=1 << 16):
+        return cls.from_chunks(read_chunks(source_file, chunk_size), source)
+
+    def append(self, group, code, content, line, begin, end):
+        if code is None:
+            code = self.intern(content)
+        self.groups.append(group)
+        self.codes.append(code)
+        self.lines.append(line)
+        self.begins.append(begin)
+        self.ends.append(end)
+
+    def intern(self, content):
+        if content not in self.string_index:
+            self.string_index[content] = len(self.strings)
+            self.strings.append(content)
+        return self.string_index[content]
 
-    current_span = Span(source, line, 0, 0)
-    for char in source.text:
-        char_index += 1
+    def __len__(self):
+        return len(self.groups)
 
-        if (current_token and (not compatible(current_token, char)
-                               or char in string.whitespace)):
-            tokens.append(create_token(current_token, current_span))
-            current_span.end = char_index
-            current_span = Span(source, line, char_index, char_index)
-            current_token = ""
+    def __getitem__(self, index):
+        return TokenView(self, index)
 
-        if char == '\n':
-            line += 1
-        if char in string.whitespace: continue
+    def content(self, index):
+        group = self.groups[index]
+        if group in group_to_strings:
+            return group_to_strings[group][self.codes[index]]
+        return self.strings[self.codes[index]]
 
-        current_token += char
+    def span(self, index):
+        return Span(self.source, self.lines[index], self.begins[index],
+                    self.ends[index])
 
-    if current_token:
-        tokens.append(create_token(current_token, current_span))
-    return Tokens(tokens)
+    def token(self, index):
+        '''Create standalone token object'''
+        group = self.groups[index]
+        code = None
+        if group in group_to_strings:
+            code = self.codes[index]
+        return create_grouped_token(group, code, self.content(index),
+                                    self.span(index))
+
+
+group_to_strings = {
+    TokenGroup.KEYWORD: keyword_to_str,
+    TokenGroup.SYMBOL: symbol_to_str,
+    TokenGroup.OPERATOR: opetator_to_str,
+}
+
+
+class TokenView:
+    '''Token stored in TokenStore, behaves like Token'''
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def group(self):
+        return self.store.groups[self.index]
+
+    @property
+    def code(self):
+        if self.group in group_to_strings:
+            return self.store.codes[self.index]
+
+    @property
+    def content(self):
+        return self.store.content(self.index)
+
+    @property
+    def span(self):
+        return self.store.span(self.index)
+
+    @property
+    def value(self):
+        if self.group == TokenGroup.LITERAL:
+            return literal_to_value(self.content)
+
+    def __str__(self):
+        return str(self.store.token(self.index))
+
+
+class StoredTokens:
+    '''Tokens interface over TokenStore, accessed by index'''
+    def __init__(self, store):
+        self.store = store
+        self.head = 0
+
+    def next(self):
+        if len(self.store) > self.head + 1:
+            return TokenView(self.store, self.head + 1)
+
+    def current(self):
+        if len(self.store) > self.head:
+            return TokenView(self.store, self.head)
+
+    def advance(self):
+        token = self.current()
+        if self.head < len(self.store):
+            self.head += 1
+        return token
+
+    def empty(self):
+        return len(self.store) <= self.head
@@ -0,0 +1,184 @@
+"""Lockstep execution of many PMC machines with NumPy
+
+Unlike the rest of duh this module requires numpy
+"""
+import numpy as np
+
+from duh.pmc import *
+
+
+class LockstepMachines:
+    '''Many PMC machines executing the same program side by side
+
+    Memory of every machine (lane) is a row of a 2-D array,
+    registers are vectors with one entry per lane.
+    Each step executes current instruction of all running lanes at once,
+    lanes at different instructions are grouped by opcode and masked.
+    Lanes that stop are retired and skipped by following steps.
+    Values wrap around at the width of `dtype`, 16 bits like words
+    of PMC by default.
+    '''
+    MEMORY_SIZE = Machine.MEMORY_SIZE
+
+    def __init__(self, lanes, dtype=np.int16):
+        self.lanes = lanes
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        self.memory = np.zeros((self.lanes, self.MEMORY_SIZE), self.dtype)
+        self.instruction_register = np.zeros(self.lanes, self.dtype)
+        self.arithmetic_register = np.zeros(self.lanes, self.dtype)
+        self.instruction_counter = np.zeros(self.lanes, np.int64)
+        self.operand = np.zeros(self.lanes, self.dtype)
+        self.running = np.zeros(self.lanes, bool)
+        # Lanes that stopped with an error, e.g. shift by a negative number
+        self.failed = np.zeros(self.lanes, bool)
+        self.printed = [[] for _ in range(self.lanes)]
+
+    def run(self, instructions):
+        self.load_program(instructions)
+        self.execute()
+
+    def load_program(self, instructions):
+        '''Encode instructions into memory of every lane'''
+        machine = Machine()
+        image = [machine.encode(instruction) for instruction in instructions]
+        image = np.array(image, np.int64).astype(self.dtype)
+        self.memory[:, :len(image)] = image
+
+    def execute(self, max_steps=None):
+        '''Run all lanes until they stop or `max_steps` steps are done
+        Returns number of executed steps
+        '''
+        self.running[:] = True
+        lanes = np.arange(self.lanes)
+        steps = 0
+        while lanes.size and (max_steps is None or steps < max_steps):
+            lanes = self.step(lanes)
+            steps += 1
+        return steps
+
+    def step(self, lanes):
+        '''Execute single instruction on `lanes`
+        Returns lanes that are still running
+        '''
+        size = self.MEMORY_SIZE
+        memory = self.memory
+
+        pc = self.instruction_counter[lanes]
+        outside = pc >= size
+        if outside.any():
+            # Machine fails when it runs past the end of memory
+            self.retire(lanes[outside], failed=True)
+            lanes, pc = lanes[~outside], pc[~outside]
+
+        register = memory[lanes, pc]
+        self.instruction_register[lanes] = register
+        pc = pc + 1
+        code = register.astype(np.int64) & 0xffff
+        opcode = (code & Machine.OP_MASK) >> Machine.OP_OFFSET
+        mode = (code & Machine.ADDR_MODE_MASK) >> Machine.ADDR_MODE_OFFSET
+        addr = (code & Machine.ADDR_MASK) >> Machine.ADDR_OFFSET
+        addr = np.where(code & Machine.SIGN_MASK, -addr, addr)
+
+        ac = self.arithmetic_register[lanes].astype(np.int64)
+        op, stopped = self.operands(lanes, mode, addr, ac)
+        failed = np.zeros(lanes.size, bool)
+
+        counts = np.bincount(opcode, minlength=len(Instruction.TO_STR))
+        for instruction in np.flatnonzero(counts):
+            mask = (opcode == instruction) & ~stopped
+            if instruction == Instruction.STOP:
+                stopped |= mask
+            elif instruction == Instruction.LOAD:
+                ac[mask] = op[mask]
+            elif instruction == Instruction.STORE:
+                invalid = mask & ((op < 0) | (op >= size))
+                stopped |= invalid
+                mask &= ~invalid
+                memory[lanes[mask], op[mask]] = ac[mask].astype(self.dtype)
+            elif instruction in jump_conditions:
+                mask &= jump_conditions[instruction](ac)
+                invalid = mask & ((op < 0) | (op >= size))
+                stopped |= invalid
+                mask &= ~invalid
+                pc[mask] = op[mask]
+            elif instruction == Instruction.PRINT:
+                for lane, value in zip(lanes[mask], op[mask]):
+                    self.printed[lane].append(int(value))
+            elif instruction in (Instruction.SHL, Instruction.SHR):
+                negative = mask & (op < 0)
+                failed |= negative
+                mask &= ~negative
+                ac[mask] = vector_operations[instruction](ac[mask], op[mask])
+            elif instruction in vector_operations:
+                ac[mask] = vector_operations[instruction](ac[mask], op[mask])
+
+        self.arithmetic_register[lanes] = ac.astype(self.dtype)
+        self.operand[lanes] = op.astype(self.dtype)
+        self.instruction_counter[lanes] = pc
+
+        self.retire(lanes[stopped & ~failed])
+        self.retire(lanes[failed], failed=True)
+        return lanes[~(stopped | failed)]
+
+    def operands(self, lanes, mode, addr, ac):
+        '''Calculate operands of all lanes according to their address modes
+        Returns operands and mask of lanes stopped by invalid address
+        '''
+        size = self.MEMORY_SIZE
+        memory = self.memory
+        direct = mode == Address.DIRECT
+        indirect = mode == Address.INDIRECT
+
+        op = addr.copy()
+        stopped = (direct | indirect) & ((addr < 0) | (addr >= size))
+        if direct.any() or indirect.any():
+            first = memory[lanes, np.clip(addr, 0, size - 1)].astype(np.int64)
+            op = np.where(direct, first, op)
+        if indirect.any():
+            stopped |= indirect & ((first < 0) | (first >= size))
+            second = memory[lanes, np.clip(first, 0, size - 1)]
+            op = np.where(indirect, second.astype(np.int64), op)
+        relative = mode == Address.RELATIVE
+        if relative.any():
+            op = np.where(relative, ac + addr, op)
+        return op, stopped
+
+    def retire(self, lanes, failed=False):
+        self.running[lanes] = False
+        self.failed[lanes] = failed
+
+
+jump_conditions = {
+    Instruction.JUMP: lambda ac: np.ones(ac.shape, bool),
+    Instruction.JNEG: lambda ac: ac < 0,
+    Instruction.JZERO: lambda ac: ac == 0,
+}
+
+vector_operations = {
+    Instruction.ADD: np.add,
+    Instruction.SUB: np.subtract,
+    Instruction.SHL: lambda ac, op: np.left_shift(ac, np.minimum(op, 63)),
+    Instruction.SHR: lambda ac, op: np.right_shift(ac, np.minimum(op, 63)),
+    Instruction.AND: np.bitwise_and,
+    Instruction.OR: np.bitwise_or,
+    Instruction.XOR: np.bitwise_xor,
+    Instruction.NOT: lambda ac, _: np.invert(ac),
+}
+
+
+def run_specs(instructions, specs, dtype=np.int16):
+    '''Run program in lockstep for every (input memory, output cells) spec
+    Returns list of (printed values, output values) in order of specs
+    '''
+    specs = list(specs)
+    machines = LockstepMachines(len(specs), dtype)
+    for lane, (input_memory, _) in enumerate(specs):
+        for index, value in input_memory.items():
+            machines.memory[lane, index] = np.array(value).astype(dtype)
+    machines.run(instructions)
+    return [(machines.printed[lane],
+             [int(machines.memory[lane, index]) for index in output_memory])
+            for lane, (_, output_memory) in enumerate(specs)]
@@ -1,119 +1,156 @@
+"""Parser of duh programs
+
+Parsing functions are generators so that nesting doesn't use Python stack.
+To parse a nested construct a function yields the parsing function
+and receives the parsed node back, `run_parser` keeps the explicit stack.
+Parsers of constructs without nested ones are plain functions listed
+in `leaf_parsers`, `run_parser` calls them directly.
+"""
 from duh.ast import *
 from duh.lang import *
 
 
 def parse_tokens(tokens):
     root = ProgramNode()
-    root.instructions = parse_instructions(tokens)
+    root.instructions = run_parser(parse_instructions, tokens)
     return root
 
 
+def run_parser(parser, tokens):
+    '''Run generator-based parser without recursion'''
+    stack = [parser(tokens)]
+    value = None
+    while stack:
+        try:
+            subparser = stack[-1].send(value)
+        except StopIteration as result:
+            stack.pop()
+            value = result.value
+        else:
+            if subparser in leaf_parsers:
+                value = subparser(tokens)
+            else:
+                stack.append(subparser(tokens))
+                value = None
+    return value
+
+
 def parse_instructions(tokens):
     instructions = []
     while (not tokens.empty()
            and not is_symbol(tokens.current(), Symbol.RIGHT_BRACE)):
 
-        instructions.append(parse_instruction(tokens))
+        instructions.append((yield parse_instruction))
     return instructions
 
 
 def parse_instruction(tokens):
     if tokens.current().group == TokenGroup.KEYWORD:
-        return keyword_to_parser[tokens.current().code](tokens)
+        return (yield keyword_to_parser[tokens.current().code])
     else:
-        return parse_expression(tokens)
+        return (yield parse_expression)
 
 
 def parse_var(tokens):
-    tokens.advance()
+    keyword = tokens.advance()
     name = tokens.advance()
-    return VarNode(name)
+    return with_span(VarNode(name), keyword)
 
 
 def parse_cell(tokens):
-    tokens.advance()
+    keyword = tokens.advance()
     name = tokens.advance()
     address = tokens.advance()
-    return CellNode(name, address)
+    return with_span(CellNode(name, address), keyword)
 
 
 def parse_while(tokens):
-    tokens.advance()
-    cond = parse_expression(tokens)
-    block = parse_block(tokens)
-    return WhileNode(cond, block)
+    keyword = tokens.advance()
+    cond = yield parse_expression
+    block = yield parse_block
+    return with_span(WhileNode(cond, block), keyword)
 
 
 def parse_if(tokens):
-    tokens.advance()
-    cond = parse_expression(tokens)
-    block = parse_block(tokens)
+    keyword = tokens.advance()
+    cond = yield parse_expression
+    block = yield parse_block
     else_block = None
     if (not tokens.empty() and tokens.current().group == TokenGroup.KEYWORD
             and tokens.current().code == Keyword.ELSE):
         tokens.advance()
-        else_block = parse_block(tokens)
-    return IfNode(cond, block, else_block)
+        else_block = yield parse_block
+    return with_span(IfNode(cond, block, else_block), keyword)
 
 
 def parse_paren_expression(tokens):
+    paren = tokens.current()
     expect_symbol(tokens, Symbol.LEFT_PAREN)
     expr_args = []
     while (not tokens.empty()
            and not is_symbol(tokens.current(), Symbol.RIGHT_PAREN)):
         if is_symbol(tokens.current(), Symbol.LEFT_PAREN):
-            arg = parse_paren_expression(tokens)
+            arg = yield parse_paren_expression
         else:
             token = tokens.advance()
-            if type(token) in token_type_to_node_type:
-                arg = token_type_to_node_type[type(token)](token)
+            if token.group in group_to_node_type:
+                arg = group_to_node_type[token.group](token)
             else:
                 print(f"Got confused on '{token}' while parsing expression")
+                continue
         expr_args.append(arg)
     expect_symbol(tokens, Symbol.RIGHT_PAREN)
-    return ExpressionNode(expr_args)
+    return with_span(ExpressionNode(expr_args), paren)
 
 
 def parse_expression(tokens):
     if is_symbol(tokens.current(), Symbol.LEFT_PAREN):
-        expr = parse_paren_expression(tokens)
+        expr = yield parse_paren_expression
     else:
         expr = parse_non_paren_expression(tokens)
     return expr
 
 
-token_type_to_node_type = {
-    Operator: OperatorNode,
-    Identifier: IdentifierNode,
-    Literal: LiteralNode,
+group_to_node_type = {
+    TokenGroup.OPERATOR: OperatorNode,
+    TokenGroup.NAME: IdentifierNode,
+    TokenGroup.LITERAL: LiteralNode,
 }
 
 
 def parse_non_paren_expression(tokens):
     '''Non paren expression can be either an identifier or a literal'''
     token = tokens.advance()
-    return token_type_to_node_type[type(token)](token)
+    return group_to_node_type[token.group](token)
 
 
 def parse_block(tokens):
     if is_symbol(tokens.current(), Symbol.LEFT_BRACE):
-        return parse_braced_block(tokens)
+        return (yield parse_braced_block)
     else:
-        instructions = [parse_instruction(tokens)]
-        return BlockNode(instructions)
+        first = tokens.current()
+        instructions = [(yield parse_instruction)]
+        return with_span(BlockNode(instructions), first)
 
 
 def parse_braced_block(tokens):
+    brace = tokens.current()
     expect_symbol(tokens, Symbol.LEFT_BRACE)
-    instructions = parse_instructions(tokens)
+    instructions = yield parse_instructions
     expect_symbol(tokens, Symbol.RIGHT_BRACE)
-    return BlockNode(instructions)
+    return with_span(BlockNode(instructions), brace)
 
 
 def parse_print(tokens):
-    tokens.advance()
-    expression = parse_expression(tokens)
-    return PrintNode(expression)
+    keyword = tokens.advance()
+    expression = yield parse_expression
+    return with_span(PrintNode(expression), keyword)
+
+
+def with_span(node, token):
+    '''Mark node as starting at token'''
+    node.start = token
+    return node
 
 
 class ParsingError(Exception):
@@ -147,3 +184,6 @@ keyword_to_parser = {
     Keyword.IF: parse_if,
     Keyword.PRINT: parse_print,
 }
+
+# Parsers that return the node instead of being generators
+leaf_parsers = {parse_var, parse_cell}
@@ -1,4 +1,8 @@
 """PMC interpreter - executes bytecode"""
+import copy
+from array import array
+
+
 class Address:
     IMMEDIATE, DIRECT, INDIRECT, RELATIVE = range(4)
     TO_STR = ['.', '@', '*', '+']
@@ -26,6 +30,8 @@ class Instruction:
         if address is None:
             address = Address(0)
         self.address = address
+        # AST nodes the instruction was compiled from, innermost first
+        self.origins = []
 
     def __str__(self):
         line = self.line.value
@@ -36,8 +42,51 @@ class Instruction:
         return f"{line}: {instr} {addr_mode} {addr}"
 
 
+def to_word(value):
+    '''Wrap integer around to signed 16-bit word'''
+    return ((value + 0x8000) & 0xffff) - 0x8000
+
+
+class ListMemory:
+    '''Memory kept as a list of unbounded integers'''
+    wraps = False
+
+    @staticmethod
+    def create(values):
+        return list(values)
+
+    @staticmethod
+    def word(value):
+        return value
+
+
+class WordMemory:
+    '''Memory kept as array of signed 16-bit words
+    Values stored in memory and AC wrap around like in real PMC
+    '''
+    wraps = True
+
+    @staticmethod
+    def create(values):
+        return array('h', map(to_word, values))
+
+    word = staticmethod(to_word)
+
+
+class MachineState:
+    '''Copy of memory and registers of a Machine'''
+    def __init__(self, machine):
+        self.memory = tuple(machine.memory)
+        self.instruction_register = machine.instruction_register
+        self.arithmetic_register = machine.arithmetic_register
+        self.instruction_counter = machine.instruction_counter
+        self.operand = machine.operand
+
+
 class Machine:
     MEMORY_SIZE = 512
+    # Opcode put into decoded memory to pause execution
+    BREAKPOINT = -1
 
     SIGN_BITS = 1
     OP_BITS = 4
@@ -54,26 +103,166 @@ class Machine:
     ADDR_MODE_OFFSET = 9
     ADDR_OFFSET = 0
 
-    def __init__(self):
+    def __init__(self, memory_backend=ListMemory):
+        self.memory_backend = memory_backend
         self.reset()
 
     def run(self, instructions):
+        self.load_program(instructions)
+        self.execute()
+
+    def load_program(self, instructions):
+        memory = self.own_memory()
+        word = self.memory_backend.word
         for index, instruction in enumerate(instructions):
-            self.memory[index] = self.encode(instruction)
+            memory[index] = word(self.encode(instruction))
+
+    def write(self, index, value):
+        '''Set memory cell, copying memory first if it's shared'''
+        self.own_memory()[index] = self.memory_backend.word(value)
+
+    def own_memory(self):
+        '''Make sure memory isn't shared with a forked machine'''
+        if self.shared_memory:
+            self.memory = self.memory[:]
+            self.shared_memory = False
+        return self.memory
+
+    def snapshot(self):
+        return MachineState(self)
+
+    def restore(self, state):
+        self.memory = self.memory_backend.create(state.memory)
+        self.shared_memory = False
+        self.instruction_register = state.instruction_register
+        self.arithmetic_register = state.arithmetic_register
+        self.instruction_counter = state.instruction_counter
+        self.operand = state.operand
+        self.running = False
 
+    def fork(self):
+        '''Create a copy of the machine sharing memory until it's written'''
+        child = copy.copy(self)
+        self.shared_memory = child.shared_memory = True
+        return child
+
+    def step(self):
+        '''Execute a single cycle decoding IR from scratch'''
+        self.instruction_register = self.memory[self.instruction_counter]
+        self.instruction_counter += 1
+        instruction = self.decode(self.instruction_register)
+        addr_mode_to_function[instruction.address_mode](
+            self, instruction.address.value)
+
+        if not self.running: return
+        op_to_function[instruction.code](self)
+
+    def interpret(self):
+        '''Run the machine one decoded cycle at a time'''
         self.running = True
         while self.running:
-            self.instruction_register = self.memory[self.instruction_counter]
-            self.instruction_counter += 1
-            instruction = self.decode(self.instruction_register)
-            addr_mode_to_function[instruction.address_mode](
-                self, instruction.address.value)
+            self.step()
+
+    def predecode(self):
+        '''Decode whole memory into a table of (opcode, mode, address)'''
+        self.decoded = [decode_fields(code) for code in self.memory]
+        return self.decoded
+
+    def execute(self, breakpoint=None):
+        '''Run the machine using predecoded memory
+        Only cells written by STORE are decoded again,
+        so self-modifying programs behave as in `interpret`
+
+        When PC reaches `breakpoint` the machine is paused before
+        executing the instruction and stays running, so it can be resumed.
+        '''
+        memory = self.memory
+        decoded = self.predecode()
+        if breakpoint is not None:
+            decoded[breakpoint] = (self.BREAKPOINT, self.BREAKPOINT, 0)
+        size = self.MEMORY_SIZE
+        wraps = self.memory_backend.wraps
+        ac = self.arithmetic_register
+        pc = self.instruction_counter
+        op = self.operand
+        current = pc
 
-            if not self.running: break
-            op_to_function[instruction.code](self)
+        self.running = True
+        while True:
+            current = pc
+            opcode, mode, addr = decoded[current]
+            pc = current + 1
+
+            if mode == Address.DIRECT:
+                if not 0 <= addr < size: break
+                op = memory[addr]
+            elif mode == Address.IMMEDIATE:
+                op = addr
+            elif mode == Address.INDIRECT:
+                if not 0 <= addr < size: break
+                op = memory[addr]
+                if not 0 <= op < size: break
+                op = memory[op]
+            elif mode == Address.RELATIVE:
+                op = ac + addr
+                if wraps: op = to_word(op)
+
+            if opcode == Instruction.LOAD:
+                ac = op
+            elif opcode == Instruction.STORE:
+                if not 0 <= op < size: break
+                if self.shared_memory: memory = self.own_memory()
+                memory[op] = ac
+                decoded[op] = decode_fields(ac)
+            elif opcode == Instruction.JUMP:
+                if not 0 <= op < size: break
+                pc = op
+            elif opcode == Instruction.JNEG:
+                if ac < 0:
+                    if not 0 <= op < size: break
+                    pc = op
+            elif opcode == Instruction.JZERO:
+                if ac == 0:
+                    if not 0 <= op < size: break
+                    pc = op
+            elif opcode == Instruction.ADD:
+                ac += op
+                if wraps: ac = to_word(ac)
+            elif opcode == Instruction.SUB:
+                ac -= op
+                if wraps: ac = to_word(ac)
+            elif opcode == Instruction.SHL:
+                ac <<= op
+                if wraps: ac = to_word(ac)
+            elif opcode == Instruction.SHR:
+                ac >>= op
+            elif opcode == Instruction.AND:
+                ac &= op
+            elif opcode == Instruction.OR:
+                ac |= op
+            elif opcode == Instruction.XOR:
+                ac ^= op
+            elif opcode == Instruction.NOT:
+                ac = ~ac
+            elif opcode == Instruction.PRINT:
+                print(op)
+            elif opcode == Instruction.STOP:
+                break
+            elif opcode == self.BREAKPOINT:
+                self.instruction_counter = current
+                self.arithmetic_register = ac
+                self.operand = op
+                return
+
+        self.instruction_register = memory[current]
+        self.instruction_counter = pc
+        self.arithmetic_register = ac
+        self.operand = op
+        self.running = False
 
     def reset(self):
-        self.memory = [0] * self.MEMORY_SIZE
+        self.memory = self.memory_backend.create([0] * self.MEMORY_SIZE)
+        self.shared_memory = False
         self.instruction_register = 0
         self.arithmetic_register = 0
         self.instruction_counter = 0
@@ -122,14 +311,15 @@ class Machine:
 
     def calculate(self, op):
         '''Evaluate function on AC and operand'''
-        self.arithmetic_register = op(self.arithmetic_register, self.operand)
+        self.arithmetic_register = self.memory_backend.word(
+            op(self.arithmetic_register, self.operand))
 
     def load(self):
         self.arithmetic_register = self.operand
 
     def store(self):
         self.access(self.operand)
-        self.memory[self.operand] = self.arithmetic_register
+        self.own_memory()[self.operand] = self.arithmetic_register
 
     def jump(self, condition):
         if condition(self):
@@ -137,6 +327,15 @@ class Machine:
             self.instruction_counter = self.operand
 
 
+def decode_fields(code):
+    '''Split encoded instruction into (opcode, address mode, address)'''
+    opcode = (code & Machine.OP_MASK) >> Machine.OP_OFFSET
+    addr_mode = (code & Machine.ADDR_MODE_MASK) >> Machine.ADDR_MODE_OFFSET
+    addr = (code & Machine.ADDR_MASK) >> Machine.ADDR_OFFSET
+    if code & Machine.SIGN_MASK: addr = -addr
+    return opcode, addr_mode, addr
+
+
 def addr_immediate(machine, addr):
     machine.operand = addr
 
@@ -150,7 +349,8 @@ def addr_indirect(machine, addr):
 
 
 def addr_relative(machine, addr):
-    machine.operand = machine.arithmetic_register + addr
+    machine.operand = machine.memory_backend.word(
+        machine.arithmetic_register + addr)
 
 
 addr_mode_to_function = {
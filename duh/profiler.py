@@ -0,0 +1,166 @@
+"""Profiling of PMC programs"""
+from array import array
+from collections import Counter
+
+from duh.ast import IfNode, WhileNode
+from duh.pmc import *
+
+
+class ProfilingMachine(Machine):
+    '''Machine counting executed instructions
+
+    Counts executions of every address, of every opcode and address mode
+    pair, taken and not taken conditional jumps and taken back-edges
+    of jumps to fixed addresses.
+    Counters are kept between runs until reset.
+    '''
+    CONDITIONS = {
+        Instruction.JNEG: lambda ac: ac < 0,
+        Instruction.JZERO: lambda ac: ac == 0,
+    }
+
+    def reset(self):
+        super().reset()
+        size = self.MEMORY_SIZE
+        self.executions = array('Q', bytes(8 * size))
+        self.kinds = array('Q', bytes(8 * 16 * 4))
+        self.taken = array('Q', bytes(8 * size))
+        self.not_taken = array('Q', bytes(8 * size))
+        self.back_edges = Counter()
+
+    def execute(self, breakpoint=None):
+        decoded = self.predecode()
+        executions = self.executions
+        kinds = self.kinds
+        self.running = True
+        while self.running:
+            current = self.instruction_counter
+            if current == breakpoint: return
+            opcode, mode, addr = decoded[current]
+            self.instruction_register = self.memory[current]
+            self.instruction_counter = current + 1
+            executions[current] += 1
+            kinds[opcode * 4 + mode] += 1
+
+            addr_mode_to_function[mode](self, addr)
+            if not self.running: break
+            op_to_function[opcode](self)
+
+            if opcode == Instruction.STORE and self.running:
+                decoded[self.operand] = decode_fields(
+                    self.memory[self.operand])
+            elif opcode in self.CONDITIONS:
+                if self.CONDITIONS[opcode](self.arithmetic_register):
+                    self.taken[current] += 1
+                    self.count_edge(current)
+                else:
+                    self.not_taken[current] += 1
+            elif opcode == Instruction.JUMP and mode == Address.IMMEDIATE:
+                # Computed jumps, like returns from routines, aren't loops
+                self.count_edge(current)
+
+    def count_edge(self, source):
+        if self.running and self.operand <= source:
+            self.back_edges[source, self.operand] += 1
+
+    def total(self):
+        return sum(self.executions)
+
+    def hottest(self, count=10):
+        '''Most executed addresses with their execution counts'''
+        lines = [(n, line) for line, n in enumerate(self.executions) if n]
+        return [(line, n) for n, line in sorted(lines, reverse=True)[:count]]
+
+    def loops(self, count=10):
+        '''Loops found by back-edges, sorted by executed instructions
+        Returns tuples (begin, end, iterations, executed instructions)
+        '''
+        loops = []
+        for (end, begin), iterations in self.back_edges.items():
+            executed = sum(self.executions[begin:end + 1])
+            loops.append((begin, end, iterations, executed))
+        loops.sort(key=lambda loop: loop[3], reverse=True)
+        return loops[:count]
+
+    def disassemble(self, line):
+        instruction = self.decode(self.memory[line])
+        instruction.line.value = line
+        return str(instruction)
+
+    def report(self, count=10):
+        '''Human readable summary of collected counters'''
+        total = self.total() or 1
+        result = f"Executed instructions: {self.total()}\n"
+
+        result += "\nHottest addresses:\n"
+        for line, n in self.hottest(count):
+            result += f"{n:>12} {n / total:>7.2%}  {self.disassemble(line)}"
+            if self.taken[line] or self.not_taken[line]:
+                result += (f"  (taken {self.taken[line]},"
+                           f" not taken {self.not_taken[line]})")
+            result += "\n"
+
+        result += "\nLoops:\n"
+        for begin, end, iterations, executed in self.loops(count):
+            result += (f"{executed:>12} {executed / total:>7.2%}"
+                       f"  {begin}-{end}, {iterations} iterations\n")
+            for line in range(begin, end + 1):
+                result += f"{self.executions[line]:>22}  "
+                result += f"{self.disassemble(line)}\n"
+
+        result += "\nInstruction kinds:\n"
+        kinds = [(n, kind) for kind, n in enumerate(self.kinds) if n]
+        for n, kind in sorted(kinds, reverse=True):
+            opcode, mode = divmod(kind, 4)
+            name = f"{Instruction.TO_STR[opcode]} {Address.TO_STR[mode]}"
+            result += f"{n:>12} {n / total:>7.2%}  {name}\n"
+        return result
+
+
+class SourceProfile:
+    '''Instructions executed by ProfilingMachine attributed to duh source
+    using source map of the compiled program
+    '''
+    def __init__(self, machine, source_map):
+        self.total = machine.total()
+        # Executed instructions per source line, None for compiler's code
+        self.lines = Counter()
+        # Executed instructions per while or if, including nested statements
+        self.statements = Counter()
+        self.source = None
+        self.source_lines = None
+        for address, count in enumerate(machine.executions):
+            if not count or address >= len(source_map): continue
+            span = source_map.span(address)
+            if span is None:
+                self.lines[None] += count
+            else:
+                self.lines[span.line] += count
+                self.source = span.source
+            for node in source_map.nodes(address):
+                if isinstance(node, (WhileNode, IfNode)):
+                    self.statements[node] += count
+
+    def report(self, count=10):
+        total = self.total or 1
+        result = "Hottest lines:\n"
+        for line, n in self.lines.most_common(count):
+            text = "(generated)"
+            if line is not None:
+                text = f"{line + 1}: {self.line_text(line)}"
+            result += f"{n:>12} {n / total:>7.2%}  {text}\n"
+
+        result += "\nHottest statements:\n"
+        for node, n in self.statements.most_common(count):
+            name = "while" if isinstance(node, WhileNode) else "if"
+            line = node.span.line
+            result += (f"{n:>12} {n / total:>7.2%}  {name} at line"
+                       f" {line + 1}: {self.line_text(line)}\n")
+        return result
+
+    def line_text(self, line):
+        if self.source_lines is None:
+            self.source_lines = self.source.lines() if self.source else []
+        if line < len(self.source_lines):
+            return self.source_lines[line].strip()
+        return ""
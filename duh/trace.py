@@ -0,0 +1,220 @@
+"""Recording and replaying execution traces of PMC machine
+
+Trace file starts with a header followed by initial memory of the machine
+and fixed-width little-endian records, one per executed instruction:
+    PC (uint16), IR (int64), AC (int64), OP (int64)
+where AC and OP are values after the instruction was executed.
+"""
+import mmap
+import struct
+from collections import namedtuple
+
+from duh.pmc import *
+
+MAGIC = b'DUHTRACE'
+VERSION = 1
+HEADER = struct.Struct('<8sHHI')
+RECORD = struct.Struct('<Hqqq')
+WORD = struct.Struct('<q')
+
+TraceRecord = namedtuple('TraceRecord', ['pc', 'ir', 'ac', 'op'])
+
+
+class TraceError(Exception):
+    pass
+
+
+def to_int64(value):
+    return ((value + (1 << 63)) & ((1 << 64) - 1)) - (1 << 63)
+
+
+class TraceWriter:
+    '''Writes records to trace file in chunks of `chunk_records` records
+    The file is truncated and starts with `memory`, unless `append` is set
+    to continue a trace of a resumed machine
+    '''
+    def __init__(self, path, memory, chunk_records=1 << 16, append=False):
+        self.file = open(path, 'ab' if append else 'wb')
+        if self.file.tell() == 0:
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size,
+                                        len(memory)))
+            self.file.write(pack_values(memory))
+        self.chunk_records = chunk_records
+        self.chunk = struct.Struct('<' + 'Hqqq' * chunk_records)
+        self.values = []
+
+    def record(self, pc, ir, ac, op):
+        self.values += (pc, ir, ac, op)
+        if len(self.values) == 4 * self.chunk_records:
+            self.write_chunk()
+
+    def write_chunk(self):
+        try:
+            self.file.write(self.chunk.pack(*self.values))
+        except struct.error:
+            self.file.write(pack_records(self.values))
+        self.values = []
+
+    def flush(self):
+        if self.values:
+            self.file.write(pack_records(self.values))
+            self.values = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def pack_values(values):
+    return b''.join(WORD.pack(to_int64(value)) for value in values)
+
+
+def pack_records(values):
+    '''Pack flat list of record fields, wrapping values to 64 bits'''
+    return b''.join(
+        RECORD.pack(values[i], to_int64(values[i + 1]),
+                    to_int64(values[i + 2]), to_int64(values[i + 3]))
+        for i in range(0, len(values), 4))
+
+
+class TracingMachine(Machine):
+    '''Machine appending a record of every executed instruction to a file'''
+    def __init__(self,
+                 trace_path,
+                 memory_backend=ListMemory,
+                 chunk_records=1 << 16):
+        self.trace_path = trace_path
+        self.chunk_records = chunk_records
+        super().__init__(memory_backend)
+
+    def execute(self, breakpoint=None):
+        decoded = self.predecode()
+        # Machine paused at a breakpoint is still running and continues
+        # its trace, otherwise a new one is started
+        with TraceWriter(self.trace_path, self.memory, self.chunk_records,
+                         append=self.running) as writer:
+            record = writer.record
+            self.running = True
+            while self.running:
+                current = self.instruction_counter
+                if current == breakpoint: return
+                opcode, mode, addr = decoded[current]
+                self.instruction_register = self.memory[current]
+                self.instruction_counter = current + 1
+
+                addr_mode_to_function[mode](self, addr)
+                if self.running:
+                    op_to_function[opcode](self)
+                if opcode == Instruction.STORE and self.running:
+                    decoded[self.operand] = decode_fields(
+                        self.memory[self.operand])
+                record(current, self.instruction_register,
+                       self.arithmetic_register, self.operand or 0)
+
+
+class Trace:
+    '''Read-only view of a trace file mapped into memory'''
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise TraceError(f"{path} is too short to be a trace")
+        magic, version, record_size, memory_size = HEADER.unpack_from(
+            self.map)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise TraceError(f"{path} is not a trace of supported version")
+        self.memory_size = memory_size
+        self.records_offset = HEADER.size + WORD.size * memory_size
+        self.length = (len(self.map) - self.records_offset) // RECORD.size
+
+    def initial_memory(self):
+        return [
+            WORD.unpack_from(self.map, HEADER.size + WORD.size * i)[0]
+            for i in range(self.memory_size)
+        ]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0: index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("trace index out of range")
+        offset = self.records_offset + index * RECORD.size
+        return TraceRecord(*RECORD.unpack_from(self.map, offset))
+
+    def __iter__(self):
+        end = self.records_offset + self.length * RECORD.size
+        view = memoryview(self.map)[self.records_offset:end]
+        try:
+            for fields in RECORD.iter_unpack(view):
+                yield TraceRecord(*fields)
+        finally:
+            view.release()
+
+    def instruction(self, index):
+        '''Instruction executed in step `index`'''
+        record = self[index]
+        opcode, mode, addr = decode_fields(record.ir)
+        instruction = Instruction(opcode, Address(addr), mode)
+        instruction.line.value = record.pc
+        return instruction
+
+    def steps_at(self, pc):
+        '''Indices of steps that executed instruction at address `pc`'''
+        return [i for i, record in enumerate(self) if record.pc == pc]
+
+    def replay(self, steps=None):
+        '''Yields (record, memory) after each of the first `steps` steps
+        Memory is rebuilt from initial memory and stores in the trace,
+        the same list is updated in place between steps
+        '''
+        memory = self.initial_memory()
+        records = iter(self)
+        try:
+            for index, record in enumerate(records):
+                if steps is not None and index >= steps: return
+                opcode = decode_fields(record.ir)[0]
+                if (opcode == Instruction.STORE
+                        and 0 <= record.op < self.memory_size):
+                    memory[record.op] = record.ac
+                yield record, memory
+        finally:
+            records.close()
+
+    def state(self, index):
+        '''Machine with memory and registers as after step `index`'''
+        if index < 0: index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("trace index out of range")
+        machine = Machine()
+        for record, memory in self.replay(index + 1):
+            pass
+        machine.memory = memory
+        machine.instruction_register = record.ir
+        if index + 1 < self.length:
+            machine.instruction_counter = self[index + 1].pc
+        else:
+            machine.instruction_counter = record.pc + 1
+        machine.arithmetic_register = record.ac
+        machine.operand = record.op
+        return machine
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,279 @@
+"""Translation of PMC basic blocks into Python functions"""
+from duh.pmc import *
+
+
+class Halt(Exception):
+    '''Raised by translated code when the machine stops'''
+    def __init__(self, pc, ac, op):
+        super().__init__(pc)
+        self.pc = pc
+        self.ac = ac
+        self.op = op
+
+
+class Pause(Exception):
+    '''Raised when execution reaches the breakpoint'''
+    def __init__(self, pc, ac):
+        super().__init__(pc)
+        self.pc = pc
+        self.ac = ac
+
+
+class Block:
+    '''Translated piece of code starting at `start` and covering `lines`'''
+    def __init__(self, start, lines, source, function):
+        self.start = start
+        self.lines = lines
+        self.source = source
+        self.function = function
+
+
+class TranslatingMachine(Machine):
+    '''Machine that executes programs as translated basic blocks
+
+    Program is split at jump targets and after jump instructions.
+    Unconditional jumps with immediate targets are followed,
+    so a whole loop usually ends up in a single block.
+    Each block is a Python function taking AC and returning (PC, AC).
+    Block is dropped as soon as STORE writes into one of its lines.
+    '''
+    JUMPS = (Instruction.JUMP, Instruction.JNEG, Instruction.JZERO)
+
+    def reset(self):
+        super().reset()
+        self.blocks = {}
+
+    def execute(self, breakpoint=None):
+        self.own_memory()
+        self.predecode()
+        self.leaders = self.find_leaders()
+        self.breakpoint = breakpoint
+        self.blocks = {}
+        self.owners = [[] for _ in range(self.MEMORY_SIZE)]
+        self.functions = [
+            self.translator(addr) for addr in range(self.MEMORY_SIZE)
+        ]
+        if breakpoint is not None:
+            self.functions[breakpoint] = self.pause(breakpoint)
+        self.namespace = {
+            'memory': self.memory,
+            'decoded': self.decoded,
+            'decode_fields': decode_fields,
+            'owners': self.owners,
+            'invalidate': self.invalidate,
+            'Halt': Halt,
+            'to_word': to_word,
+        }
+
+        functions = self.functions
+        pc = self.instruction_counter
+        ac = self.arithmetic_register
+        self.running = True
+        try:
+            while True:
+                pc, ac = functions[pc](ac)
+        except Halt as halt:
+            self.instruction_register = self.memory[halt.pc]
+            self.instruction_counter = halt.pc + 1
+            self.arithmetic_register = halt.ac
+            self.operand = halt.op
+        except Pause as pause:
+            self.instruction_counter = pause.pc
+            self.arithmetic_register = pause.ac
+            return
+        self.running = False
+
+    def find_leaders(self):
+        '''Addresses that are targets of jumps with immediate address'''
+        leaders = set()
+        for opcode, mode, addr in self.decoded:
+            if opcode in self.JUMPS and mode == Address.IMMEDIATE:
+                leaders.add(addr)
+        return leaders
+
+    def translator(self, start):
+        '''Placeholder that translates block on first entry'''
+        def translate_and_run(ac):
+            return self.translate(start).function(ac)
+
+        return translate_and_run
+
+    def pause(self, breakpoint):
+        def pause_at_breakpoint(ac):
+            raise Pause(breakpoint, ac)
+
+        return pause_at_breakpoint
+
+    def translate(self, start):
+        lines, source = translate_block(start, self.decoded, self.leaders,
+                                        self.MEMORY_SIZE, self.breakpoint,
+                                        self.memory_backend.wraps)
+        code = compile(source, f"<block {start}>", "exec")
+        exec(code, self.namespace)
+        block = Block(start, lines, source, self.namespace.pop('block'))
+
+        self.blocks[start] = block
+        self.functions[start] = block.function
+        for line in lines:
+            self.owners[line].append(start)
+        return block
+
+    def invalidate(self, addr):
+        '''Drop every block containing `addr`'''
+        for start in list(self.owners[addr]):
+            block = self.blocks.pop(start)
+            self.functions[start] = self.translator(start)
+            for line in block.lines:
+                self.owners[line].remove(start)
+
+
+def translate_block(start,
+                    decoded,
+                    leaders,
+                    size,
+                    breakpoint=None,
+                    wraps=False):
+    '''Generate source of a function executing block beginning at `start`
+    Block never continues past `breakpoint`
+    With `wraps` AC wraps around to 16 bits like in WordMemory
+    Returns lines covered by the block and the source
+    '''
+    lines = []
+    body = []
+    pc = start
+    while True:
+        if not 0 <= pc < size:
+            # Running out of memory fails the same way as in Machine
+            body.append(f"return {pc}, ac")
+            break
+        if pc == start and lines:
+            body.append("continue")
+            break
+        if pc == breakpoint:
+            body.append(f"return {pc}, ac")
+            break
+        if pc in lines:
+            body.append(f"return {pc}, ac")
+            break
+        if pc != start and pc in leaders and not following_jump(
+                decoded, lines):
+            body.append(f"return {pc}, ac")
+            break
+
+        lines.append(pc)
+        opcode, mode, addr = decoded[pc]
+        next_pc = pc + 1
+        code, ends, pc = translate_instruction(pc, opcode, mode, addr, start,
+                                               size, wraps)
+        body += code
+        if ends: break
+        if pc is None: pc = next_pc
+
+    source = "def block(ac):\n    while True:\n"
+    source += "".join(f"        {line}\n" for line in body)
+    return lines, source
+
+
+def following_jump(decoded, lines):
+    '''Whether the last translated instruction is an unconditional jump'''
+    return lines and decoded[lines[-1]][0] == Instruction.JUMP
+
+
+def translate_operand(pc, mode, addr, size, wraps):
+    '''Source computing operand of an instruction
+    Returns setup lines and expression evaluating to the operand,
+    None when the address is known to be invalid
+    '''
+    if mode == Address.IMMEDIATE:
+        return [], f"{addr}"
+    elif mode == Address.RELATIVE and wraps:
+        return [], f"to_word(ac + {addr})"
+    elif mode == Address.RELATIVE:
+        return [], f"(ac + {addr})"
+    elif not 0 <= addr < size:
+        return [], None
+    elif mode == Address.DIRECT:
+        return [], f"memory[{addr}]"
+    else:
+        return [
+            f"op = memory[{addr}]",
+            f"if not 0 <= op < {size}: raise Halt({pc}, ac, op)",
+            "op = memory[op]",
+        ], "op"
+
+
+def translate_instruction(pc, opcode, mode, addr, start, size, wraps):
+    '''Translate single instruction
+    Returns list of source lines, whether the block ends here
+    and address of the next instruction if execution doesn't fall through
+    '''
+    code, op = translate_operand(pc, mode, addr, size, wraps)
+    if op is None:
+        return [f"raise Halt({pc}, ac, None)"], True, None
+    halt = f"raise Halt({pc}, ac, {op})"
+    static = mode == Address.IMMEDIATE
+
+    if opcode in arithmetic_to_source:
+        code.append(arithmetic_to_source[opcode].format(op=op))
+        if wraps and opcode in overflowing:
+            code.append("ac = ((ac + 0x8000) & 0xffff) - 0x8000")
+    elif opcode == Instruction.LOAD:
+        code.append(f"ac = {op}")
+    elif opcode == Instruction.PRINT:
+        code.append(f"print({op})")
+    elif opcode == Instruction.STOP:
+        code.append(halt)
+        return code, True, None
+    elif (opcode in (Instruction.STORE, Instruction.JUMP) and static
+          and not 0 <= addr < size):
+        # Store or jump to an address outside of memory
+        code.append(halt)
+        return code, True, None
+    elif opcode == Instruction.STORE:
+        if not static:
+            code.append(f"op = {op}")
+            code.append(f"if not 0 <= op < {size}: raise Halt({pc}, ac, op)")
+            op = "op"
+        code.append(f"memory[{op}] = ac")
+        code.append(f"decoded[{op}] = decode_fields(ac)")
+        code.append(f"if owners[{op}]: invalidate({op}); return {pc + 1}, ac")
+    elif opcode == Instruction.JUMP:
+        if static:
+            # Follow the jump and keep translating at its target
+            return code, False, addr
+        code.append(f"op = {op}")
+        code.append(f"if not 0 <= op < {size}: raise Halt({pc}, ac, op)")
+        code.append("return op, ac")
+        return code, True, None
+    elif opcode in (Instruction.JNEG, Instruction.JZERO):
+        condition = "ac < 0" if opcode == Instruction.JNEG else "ac == 0"
+        code.append(f"if {condition}:")
+        if static and addr == start:
+            code.append("    continue")
+        elif static and 0 <= addr < size:
+            code.append(f"    return {addr}, ac")
+        else:
+            code.append(f"    op = {op}")
+            code.append(
+                f"    if not 0 <= op < {size}: raise Halt({pc}, ac, op)")
+            code.append("    return op, ac")
+        code.append(f"return {pc + 1}, ac")
+        return code, True, None
+
+    return code, False, None
+
+
+arithmetic_to_source = {
+    Instruction.ADD: "ac += {op}",
+    Instruction.SUB: "ac -= {op}",
+    Instruction.SHL: "ac <<= {op}",
+    Instruction.SHR: "ac >>= {op}",
+    Instruction.AND: "ac &= {op}",
+    Instruction.OR: "ac |= {op}",
+    Instruction.XOR: "ac ^= {op}",
+    Instruction.NOT: "ac = ~ac",
+    Instruction.NULL: "pass",
+}
+
+# Operations that can leave 16-bit range when operands are in it
+overflowing = (Instruction.ADD, Instruction.SUB, Instruction.SHL)
@@ -1,12 +1,17 @@
 """main file of duh compiler"""
 import sys
+import io
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 
 from duh.lang import Source
-from duh.lexer import lex
+from duh.lexer import lex, lex_file
 from duh.parser import parse_tokens
 from duh.compiler.compile import compile_program
 from duh.compiler.core import SimpleCompiler
 from duh.pmc import Machine
+from duh.profiler import ProfilingMachine, SourceProfile
+from duh.trace import TracingMachine
 
 
 def compile_source(source):
@@ -17,21 +22,31 @@ def compile_source(source):
     return instructions
 
 
-def run_program(instructions, input_memory={}, output_memory=[]):
+def compile_source_file(source_name):
+    """Compile file streaming it through the lexer"""
+    with open(source_name, "r", encoding="utf-8") as source_file:
+        tokens = lex_file(source_file, Source(source_name))
+        program_node = parse_tokens(tokens)
+    return compile_program(program_node, SimpleCompiler)
+
+
+def run_program(instructions,
+                input_memory={},
+                output_memory=[],
+                machine_type=Machine):
     """Run instructions on PMC machine"""
-    machine = Machine()
+    machine = machine_type()
     for index, value in input_memory.items():
         machine.memory[index] = value
     machine.run(instructions)
     for index in output_memory:
         print(machine.memory[index])
+    return machine
 
 
 def compile_file(source_name, target_name):
     """Compile `source_name` file and save as `target_name` file"""
-    with open(source_name, "r", encoding="utf-8") as source_file:
-        source = Source(source_name, source_file.read())
-        instructions = compile_source(source)
+    instructions = compile_source_file(source_name)
     compiled_code = str(instructions)
     with open(target_name, "w", encoding="utf-8") as target_file:
         target_file.write(compiled_code)
@@ -47,30 +62,138 @@ def run_file(source_name):
 
 def run_duh_file(source_name):
     """Executes file in duh language"""
-    with open(source_name, "r", encoding="utf-8") as source_file:
-        source = Source(source_name, source_file.read())
-        instructions = compile_source(source)
+    instructions = compile_source_file(source_name)
+
+    input_memory, output_memory = read_input_spec(input)
+    run_program(instructions, input_memory, output_memory)
+
+
+def profile_duh_file(source_name):
+    """Executes file in duh language and reports where cycles were spent"""
+    instructions = compile_source_file(source_name)
 
-    inp, out = [int(i) for i in input().split()]
+    input_memory, output_memory = read_input_spec(input)
+    machine = run_program(instructions, input_memory, output_memory,
+                          ProfilingMachine)
+    print(machine.report(), file=sys.stderr)
+    source_profile = SourceProfile(machine, instructions.source_map)
+    print(source_profile.report(), file=sys.stderr)
+
+
+def trace_duh_file(source_name, trace_name):
+    """Executes file in duh language recording trace into `trace_name`"""
+    instructions = compile_source_file(source_name)
+
+    input_memory, output_memory = read_input_spec(input)
+    run_program(instructions, input_memory, output_memory,
+                lambda: TracingMachine(trace_name))
+
+
+def read_input_spec(read_line):
+    """Read description of input and output cells using `read_line`"""
+    inp, out = [int(i) for i in read_line().split()]
     input_memory = {}
     for _ in range(inp):
-        index, value = [int(i) for i in input().split(':')]
+        index, value = [int(i) for i in read_line().split(':')]
         input_memory[index] = value
 
     output_memory = []
     for _ in range(out):
-        output_memory.append(int(input()))
+        output_memory.append(int(read_line()))
 
-    run_program(instructions, input_memory, output_memory)
+    return input_memory, output_memory
+
+
+def read_input_specs(lines):
+    """Read input specs one after another until `lines` are exhausted"""
+    lines = (line for line in lines if line.strip())
+    read_line = lambda: next(lines)
+    while True:
+        try:
+            yield read_input_spec(read_line)
+        except StopIteration:
+            return
+
+
+def encode_program(instructions):
+    """Encode instructions into memory image of PMC machine"""
+    machine = Machine()
+    return [machine.encode(instruction) for instruction in instructions]
+
+
+program_image = None
+
+
+def set_program_image(image):
+    """Initializer of batch workers, keeps image for all runs in the worker"""
+    global program_image
+    program_image = image
+
+
+def run_image(spec):
+    """Run `program_image` on input spec
+    Returns text printed by the program and values of output cells
+    """
+    input_memory, output_memory = spec
+    machine = Machine()
+    for index, value in input_memory.items():
+        machine.memory[index] = value
+    machine.memory[:len(program_image)] = program_image
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        machine.execute()
+    return printed.getvalue(), [machine.memory[i] for i in output_memory]
+
+
+def run_batch(instructions, specs, workers=None, chunksize=1):
+    """Run compiled program on every input spec in a process pool
+    Results are yielded in the order of `specs` as soon as they're ready
+    """
+    image = encode_program(instructions)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=set_program_image,
+                             initargs=(image, )) as executor:
+        yield from executor.map(run_image, specs, chunksize=chunksize)
+
+
+def run_duh_file_batch(source_name, workers=None, chunksize=1):
+    """Executes file in duh language for every input spec on stdin"""
+    instructions = compile_source_file(source_name)
+
+    specs = read_input_specs(sys.stdin)
+    for printed, outputs in run_batch(instructions, specs, workers,
+                                      chunksize):
+        sys.stdout.write(printed)
+        print(*outputs)
+
+
+def run_duh_file_lockstep(source_name):
+    """Executes file in duh language for all input specs on stdin at once
+    Requires numpy
+    """
+    from duh.lockstep import run_specs
+
+    instructions = compile_source_file(source_name)
+
+    specs = read_input_specs(sys.stdin)
+    for printed, outputs in run_specs(instructions, specs):
+        for value in printed:
+            print(value)
+        print(*outputs)
 
 
 def print_usage_info():
     print("Usage:")
     print("python3 main.py {filename} {mode}")
-    print("Where mode is either --compile or --run")
+    print("Where mode is one of --compile, --run, --profile, --trace,"
+          " --batch or --lockstep")
+    print("--batch can be followed by number of workers and chunk size")
 
 if __name__ == '__main__':
-    if len(sys.argv) == 3:
+    if len(sys.argv) >= 3 and sys.argv[2] == '--batch':
+        batch_args = [int(arg) for arg in sys.argv[3:5]]
+        run_duh_file_batch(sys.argv[1], *batch_args)
+    elif len(sys.argv) == 3:
         source_file_name = sys.argv[1]
         mode = sys.argv[2]
         if mode == '--compile':
@@ -79,6 +202,14 @@ if __name__ == '__main__':
             compile_file(source_file_name, target_file_name)
         elif mode == '--run':
             run_file(source_file_name)
+        elif mode == '--trace':
+            name, _ = source_file_name.split('.')
+            trace_file_name = name + '.trace'
+            trace_duh_file(source_file_name, trace_file_name)
+        elif mode == '--profile':
+            profile_duh_file(source_file_name)
+        elif mode == '--lockstep':
+            run_duh_file_lockstep(source_file_name)
         else:
             print(f"Unknown mode `{mode}`")
             print_usage_info()
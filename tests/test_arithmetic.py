@@ -0,0 +1,108 @@
+'''Check *, / and % of compiled programs against Python
+
+Division rounds towards zero and the remainder takes the sign
+of the dividend, like in C. Dividing by zero gives quotient 0
+and leaves the dividend as remainder.
+
+Run from the root of the repository:
+    python3 -m pytest tests
+'''
+import contextlib
+import io
+
+import pytest
+
+from duh.lang import Source
+from duh.lexer import lex
+from duh.parser import parse_tokens
+from duh.compiler.compile import compile_program
+from duh.compiler.core import SimpleCompiler
+from duh.pmc import Machine, ListMemory, WordMemory, to_word
+
+
+def quotient(a, b):
+    if b == 0:
+        return 0
+    magnitude = abs(a) // abs(b)
+    return magnitude if (a < 0) == (b < 0) else -magnitude
+
+
+def remainder(a, b):
+    if b == 0:
+        return a
+    magnitude = abs(a) % abs(b)
+    return magnitude if a >= 0 else -magnitude
+
+
+operations = {
+    '*': lambda a, b: a * b,
+    '/': quotient,
+    '%': remainder,
+}
+
+# Divisors 0, ±1 and ±2^k are compiled without the division routine
+divisors = [0, 1, -1, 2, -2, 3, -3, 7, -10, 64, -64, 256, -256, 511, -511]
+
+dividends = [0, 1, -1, 5, -5, 7, -7, 100, -100, 255, -256, 511, -512,
+             1000, -1000, 12345, -12345, 32767, -32767]
+
+
+def number(value):
+    '''Expression computing `value`, literals can't be larger than 511'''
+    if abs(value) <= 511:
+        return str(value)
+    return f"(- (<< {value >> 8} 8) {-(value & 255)})"
+
+
+def run(text, memory=ListMemory, fold=True):
+    instructions = compile_program(parse_tokens(lex(Source('test', text))),
+                                   SimpleCompiler, fold=fold)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        Machine(memory).run(instructions)
+    return [int(value) for value in output.getvalue().split()]
+
+
+def variables_program(op, a, b):
+    '''Both operands are variables, values are known only at run time'''
+    return (f"var a\nvar b\n(= a {number(a)})\n(= b {number(b)})\n"
+            f"print ({op} a b)\nprint ({op} b a)\n")
+
+
+def literal_program(op, a, b):
+    '''Operand `b` is a literal, `a` is known only at run time'''
+    return (f"var a\n(= a {number(a)})\n"
+            f"print ({op} a {b})\nprint ({op} {b} a)\n")
+
+
+@pytest.mark.parametrize('op', operations)
+@pytest.mark.parametrize('program', [variables_program, literal_program])
+def test_unbounded(op, program):
+    operation = operations[op]
+    for a in dividends:
+        for b in divisors:
+            expected = [operation(a, b), operation(b, a)]
+            assert run(program(op, a, b), fold=False) == expected, (a, b)
+
+
+@pytest.mark.parametrize('op', operations)
+def test_words(op):
+    '''Results wrap around at 16 bits like in real PMC'''
+    operation = operations[op]
+    values = [-32768, -16384, -1, 0, 1, 2, 3, 7, 255, 16384, 32767, -12345]
+    for a in values:
+        for b in values:
+            expected = [to_word(operation(a, b)), to_word(operation(b, a))]
+            program = variables_program(op, a, b)
+            assert run(program, WordMemory, fold=False) == expected, (a, b)
+
+
+@pytest.mark.parametrize('op', operations)
+def test_folded(op):
+    '''Constant folding computes the same values as compiled code'''
+    operation = operations[op]
+    for a in dividends:
+        for b in divisors:
+            text = (f"var a\nvar b\n(= a {number(a)})\n(= b {b})\n"
+                    f"print ({op} a b)\nprint ({op} {number(a)} {b})\n")
+            assert run(text) == [operation(a, b)] * 2, (a, b)